@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Yotam Ben Dov 316387950
+@author: Nili Alfia 314880873
+"""
+import sys
+import os
+import time
+import json
+import errno
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+# sizes
+SMALL = 4096  # size of a small file.
+SMALL_FILES = 2000
+HUGE = 134217728  # size of a huge file.
+HUGE_FILES = 3
+DEPTH = 200  # directories nested in the deep tree, a file in each.
+RENAMES = 500  # files renamed in a storm.
+EDITED = 20  # files saved over and over by an editor.
+SAVES = 10  # saves of each.
+PROBES = 40  # single files timed one by one.
+WRITE = 1048576  # huge files are written in chunks of this size.
+
+# miscellaneous
+REPO = os.path.dirname(os.path.abspath(__file__))
+PERIOD = 2  # connection time given to the clients.
+POLL = 0.005  # seconds between checks of the receiving folder.
+GAP = 1  # seconds between probes, longer than the watcher's debounce.
+TIMEOUT = 600  # seconds a workload may take to propagate.
+READY = ".bench"  # file written until both clients are seen syncing.
+
+
+class Bench:
+    """
+    a server and two clients of a single user on localhost, each in its own
+    process and folder of a temporary directory. workloads are written into
+    the first client's folder and timed until every file shows up in the
+    second's.
+    """
+
+    def __init__(self, folder):
+        """
+        Parameters
+        ----------
+        folder : str
+            empty folder the server and clients run in.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.folder = folder
+        self.src = os.path.join(folder, "a")
+        self.dest = os.path.join(folder, "b")
+        os.makedirs(os.path.join(folder, "server"))
+        os.makedirs(self.src)
+        self.server = None
+        self.clients = []
+        self.lock = threading.Lock()
+        self.reset()
+        threading.Thread(target=self.watch, daemon=True).start()
+        try:
+            self.launch()
+        except BaseException:
+            self.stop()
+            raise
+
+    def launch(self):
+        # starts the server, then a client registering the user with its
+        # folder and one logging into it.
+        port = free_port()
+        self.server = self.start("server", "server.py", port)
+        wait_listening(port, self.server)
+        self.write(READY, 1)
+        self.clients.append(self.start("a", "client.py", "127.0.0.1", port,
+                                       self.src, PERIOD))
+        # the server prints the key of the user the first client registered.
+        key = self.server.stdout.readline().strip()
+        if not key:
+            raise RuntimeError("server exited:\n" + self.errors())
+        self.clients.append(self.start("b", "client.py", "127.0.0.1", port,
+                                       self.dest, PERIOD, key))
+        self.sync()
+        # the first client watches its folder only after its first round,
+        # writes until a change made to it shows up.
+        size = 1
+        while True:
+            size += 1
+            self.write(READY, size)
+            try:
+                self.sync(timeout=1)
+                break
+            except TimeoutError:
+                pass
+        self.reset()
+
+    def start(self, name, script, *args):
+        # runs a main of the repo in a process of its own.
+        return subprocess.Popen(
+            [sys.executable, os.path.join(REPO, script)]
+            + [str(arg) for arg in args],
+            cwd=os.path.join(self.folder, "server") if name == "server"
+            else self.folder,
+            stdout=subprocess.PIPE, text=True,
+            stderr=open(os.path.join(self.folder, name + ".err"), "w"))
+
+    def processes(self):
+        return [p for p in [self.server] + self.clients if p]
+
+    def errors(self):
+        # returns what the processes wrote to stderr.
+        text = ""
+        for name in ("server", "a", "b"):
+            path = os.path.join(self.folder, name + ".err")
+            if os.path.exists(path):
+                with open(path) as file:
+                    text += file.read()[-2000:]
+        return text
+
+    def stop(self):
+        for process in self.processes():
+            process.kill()
+            process.wait()
+
+    # workloads.
+    def reset(self):
+        # starts timing a new workload.
+        with self.lock:
+            self.expected = {}  # path -> size it should arrive with.
+            self.gone = set()  # paths that should disappear.
+            self.left = {}  # path -> (size, time it was written), not seen.
+            self.seen = {}  # path -> seconds it took to show up.
+            self.start_time = time.monotonic()
+
+    def write(self, path, size):
+        # writes a file of size bytes into the first client's folder.
+        full_path = os.path.join(self.src, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "wb") as file:
+            while size > file.tell():
+                file.write(content(min(WRITE, size - file.tell())))
+        self.done(path, size)
+
+    def done(self, path, size):
+        # notes a change made to path.
+        with self.lock:
+            self.expected[path] = size
+            self.gone.discard(path)
+            self.left[path] = (size, time.monotonic())
+            self.seen.pop(path, None)
+
+    def watch(self):
+        # notes when each change shows up in the second client's folder,
+        # while the workload is still being written.
+        while True:
+            with self.lock:
+                left = list(self.left.items())
+            for path, (size, written) in left:
+                try:
+                    if os.path.getsize(os.path.join(self.dest, path)) != size:
+                        continue
+                except OSError:
+                    continue
+                now = time.monotonic()
+                with self.lock:
+                    if self.left.get(path) == (size, written):
+                        del self.left[path]
+                        self.seen[path] = now - written
+            time.sleep(POLL)
+
+    def sync(self, timeout=TIMEOUT):
+        """
+        waits until the second client's folder holds every expected file at
+        its expected size and none of the gone ones.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            seconds to wait at most. The default is TIMEOUT.
+
+        Returns
+        -------
+        dict
+            path -> seconds from its last change until it showed up.
+
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                left = len(self.left)
+                gone = list(self.gone)
+            if not left and not any(
+                    os.path.lexists(os.path.join(self.dest, path))
+                    for path in gone):
+                break
+            for process in self.processes():
+                if process.poll() is not None:
+                    raise RuntimeError("a process exited:\n" + self.errors())
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{left} files never arrived")
+            time.sleep(POLL)
+        self.end_time = time.monotonic()
+        with self.lock:
+            return dict(self.seen)
+
+
+def small_files(bench, scale):
+    # many small files spread over a few directories.
+    for i in range(int(SMALL_FILES * scale)):
+        bench.write(os.path.join(f"small{i % 50}", f"{i}.txt"), SMALL)
+
+
+def huge_files(bench, scale):
+    # a few huge files, spread over streams.
+    for i in range(HUGE_FILES):
+        bench.write(f"huge{i}.bin", int(HUGE * scale))
+
+
+def deep_tree(bench, scale):
+    # a file in each of many nested directories.
+    path = ""
+    for i in range(int(DEPTH * scale)):
+        path = os.path.join(path, f"d{i}")
+        bench.write(os.path.join(path, "f.txt"), SMALL)
+
+
+def rename_storm(bench, scale):
+    # renames many files that were synced already, only the renames count.
+    count = int(RENAMES * scale)
+    for i in range(count):
+        bench.write(os.path.join("storm", f"{i}.txt"), SMALL + i)
+    bench.sync()
+    bench.reset()
+    for i in range(count):
+        src = os.path.join("storm", f"{i}.txt")
+        dest = os.path.join("storm", f"renamed{i}.txt")
+        os.rename(os.path.join(bench.src, src), os.path.join(bench.src, dest))
+        bench.gone.add(src)
+        bench.done(dest, SMALL + i)
+
+
+def editor_saves(bench, scale):
+    # files saved over and over the ways editors do, through a temporary
+    # file renamed over the original or with a backup of it kept meanwhile.
+    for save in range(int(SAVES * scale)):
+        for i in range(EDITED):
+            path = os.path.join(bench.src, f"edit{i}.txt")
+            size = SMALL + save
+            if save % 2:
+                temp = os.path.join(bench.src, f".edit{i}.txt.tmp")
+                with open(temp, "wb") as file:
+                    file.write(content(size))
+                os.replace(temp, path)
+            else:
+                if os.path.exists(path):
+                    os.replace(path, path + "~")
+                with open(path, "wb") as file:
+                    file.write(content(size))
+                if os.path.exists(path + "~"):
+                    os.remove(path + "~")
+            bench.done(f"edit{i}.txt", size)
+
+
+def probes(bench, scale):
+    # single small files written while the connection is idle, each timed
+    # on its own.
+    for i in range(int(PROBES * scale)):
+        bench.write(f"probe{i}.txt", SMALL)
+        bench.sync()
+        time.sleep(GAP)
+
+
+WORKLOADS = {
+    "small": small_files,
+    "huge": huge_files,
+    "deep": deep_tree,
+    "renames": rename_storm,
+    "editor": editor_saves,
+    "latency": probes,
+}
+
+
+def run(name, scale=1.0, keep=False):
+    """
+    runs a workload against a new server and clients.
+
+    Parameters
+    ----------
+    name : str
+        one of WORKLOADS.
+    scale : float, optional
+        multiplies the workload's size. The default is 1.0.
+    keep : bool, optional
+        whether to keep the folders the benchmark ran in. The default is
+        False.
+
+    Returns
+    -------
+    dict
+        the workload's results.
+
+    """
+    folder = tempfile.mkdtemp(prefix="drive-bench-")
+    bench = None
+    try:
+        bench = Bench(folder)
+        WORKLOADS[name](bench, scale)
+        latencies = sorted(bench.sync().values())
+        elapsed = bench.end_time - bench.start_time
+        size = sum(bench.expected.values())
+        files = len(bench.expected)
+        return {
+            "workload": name,
+            "files": files,
+            "mb": size / 1e6,
+            "seconds": elapsed,
+            "files/s": files / elapsed,
+            "mb/s": size / 1e6 / elapsed,
+            "p50 ms": percentile(latencies, 50) * 1000,
+            "p95 ms": percentile(latencies, 95) * 1000,
+            "p99 ms": percentile(latencies, 99) * 1000,
+            "server rss mb": peak_rss(bench.server.pid),
+            "client rss mb": max(peak_rss(c.pid) for c in bench.clients),
+        }
+    finally:
+        if bench:
+            bench.stop()
+        if keep:
+            print("kept", folder, file=sys.stderr)
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+def content(size):
+    # returns size bytes that compress about as well as text does.
+    return os.urandom(size // 2 + 1).hex()[:size].encode()
+
+
+def percentile(values, percent):
+    # returns the nearest rank percentile of sorted values.
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def peak_rss(pid):
+    # returns a process's peak resident memory in MB, 0 if unknown.
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0
+
+
+def free_port():
+    # returns a port nothing listens on.
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_listening(port, process, timeout=10):
+    # waits until the server binds port, without connecting to it.
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited before listening")
+        with socket.socket() as sock:
+            try:
+                sock.bind(("", port))
+            except OSError as error:
+                if error.errno == errno.EADDRINUSE:
+                    return
+                raise
+        time.sleep(0.05)
+    raise TimeoutError("server never started listening")
+
+
+def report(results):
+    # prints results as a table.
+    columns = list(results[0])
+    print("".join(f"{c:>14}" for c in columns))
+    for result in results:
+        print("".join(f"{v:>14.1f}" if isinstance(v, float) else f"{v:>14}"
+                      for v in result.values()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="times sync between two clients through a local server.")
+    parser.add_argument("workloads", nargs="*", default=list(WORKLOADS),
+                        metavar="workload",
+                        help=f"some of {', '.join(WORKLOADS)}, all by default")
+    parser.add_argument("-s", "--scale", type=float, default=1.0,
+                        help="multiplies the size of every workload")
+    parser.add_argument("--json", action="store_true",
+                        help="prints results as json, to compare runs")
+    parser.add_argument("--keep", action="store_true",
+                        help="keeps the folders the benchmarks ran in")
+    args = parser.parse_args()
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f"unknown workload {name}")
+    results = [run(name, args.scale, args.keep) for name in args.workloads]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
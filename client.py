@@ -4,11 +4,18 @@
 @author: Yotam Ben Dov 316387950
 @author: Nili Alfia 314880873
 """
-import sys
+import argparse
 import os
 import socket
+import select
 import time  # allowed libraries
 import utils  # in common functions
+import wire
+import merkle
+import compress
+import cluster
+import lazy
+from index import Index
 from watchdog.observers import Observer
 
 # sizes
@@ -20,13 +27,18 @@ NAME_SIZE = 10  # name shouldn't be longer than 10^10 either.
 FILE_SIZE = 16  # maximum file size at 10^16.
 ID_SIZE = 128  # default size of login key.
 CHUNK = 4096  # a moderate chunk of data.
+STREAMS = 4  # connections payloads are spread over, the first included.
+REDIRECTS = 5  # nodes of a cluster a connection may be pointed through.
 
 # miscellaneous
 FORMAT = "UTF-8"  # encoding format used.
 LOGIN = "signin"
 REGISTER = "signup"
+STREAM = "stream"  # opens another connection for a device's session.
 DONE = "done"
 UPDONE = "updone"
+WAKE = "wakeup"  # asks the server for a round on a kept connection.
+HEARTBEAT = 30  # seconds between server rounds on an idle kept connection.
 
 # file types
 FILE = "file"
@@ -39,7 +51,8 @@ DELETE = "delete"
 MODIFY = "modify"
 
 
-def main(s_ip, s_port, dir_path, connection_time, identifier=None):
+def main(s_ip, s_port, dir_path, connection_time, identifier=None, push=True,
+         rules=None):
     """
     client's main function
 
@@ -53,9 +66,16 @@ def main(s_ip, s_port, dir_path, connection_time, identifier=None):
         the chosen folder to upload from (new user) or download to (login)
     connection_time : int
         how often to try and connect with the server to update changes or get
-        updates on changes from other PCs
+        updates on changes from other PCs. when the connection is kept, the
+        longest wait between attempts to reconnect.
     identifier : string, optional
         the identifying code for a returning user. The default is None.
+    push : bool, optional
+        whether to keep the connection so changes are pushed both ways as
+        they happen, instead of polling. The default is True.
+    rules : Rules, optional
+        what this device syncs down, placeholders left for files not
+        downloaded yet. The default is None, everything.
 
     Returns
     -------
@@ -64,40 +84,141 @@ def main(s_ip, s_port, dir_path, connection_time, identifier=None):
     """
     # tupple of server details.
     server = (s_ip, s_port)
-    # sets given path as current work directory.
+    # creates given folder for a returning user, paths are relative to it.
+    # an existing one is reconciled with the server's copy.
     if identifier:
-        os.mkdir(dir_path)
-    os.chdir(dir_path)
+        os.makedirs(dir_path, exist_ok=True)
+    # the folder's state as last synced, from previous runs.
+    index = Index(dir_path)
+    device = None
+    # a folder synced here before logs back in as the same device, queuing
+    # what changed while no one was watching it.
+    if identifier and identifier == index.key and index.device:
+        device = utils.Device(index.device)
+        device.index = index
+        index.scan(device)
     # connects to server and gets client, user's key and current device.
-    client, key, device = connect(server, identifier, dir_path)
+    client, key, device = connect(server, identifier, dir_path, device,
+                                  rules)
+    device.index = index
+    index.login(key, device.get_num())
     # updates files.
-    utils.receive_updates(client, device)
-    utils.send_updates(client, device)
-    # shutdown client socket.
-    client.shutdown(socket.SHUT_RDWR)
-    client.close()
+    update(client, device, dir_path)
     # start watching directory.
     handler = utils.Handler(device, dir_path)
     observer = Observer()
     observer.schedule(handler, dir_path, recursive=True)
     observer.start()
-    # duplicate command list.
-    redundant = []
+    if push:
+        keep(client, server, key, dir_path, device, connection_time, rules)
+    # shutdown client socket.
+    client.shutdown(socket.SHUT_RDWR)
+    client.close()
     while True:
         # wait to connect to server.
         time.sleep(int(connection_time))
-        client = connect(server, key, dir_path, device)[0]
-        # receives updates and keep the redundants.
-        redundant += utils.receive_updates(client, device)
-        # sends commands while removing redundant commands.
-        utils.send_updates(client, device, redundant)
+        client = connect(server, key, dir_path, device, rules)[0]
+        update(client, device, dir_path)
         client.shutdown(socket.SHUT_RDWR)
         client.close()
 
 
-def connect(server, key, path, device=None):
+def update(client, device, dir_path):
+    # receives updates, their local echoes are dropped by the device.
+    utils.receive_updates(client, device, base=dir_path)
+    # sends commands.
+    utils.send_updates(client, device, base=dir_path, dedup=True)
+    device.index.save()
+
+
+def keep(client, server, key, dir_path, device, connection_time, rules=None):
+    """
+    keeps a connection to the server, running a round whenever the server
+    pushes one and asking for one as soon as local changes are queued.
+    reconnects with exponential backoff when the connection is lost.
+
+    Parameters
+    ----------
+    client : socket
+        connected client socket, after its first round.
+    server : tuple
+        server's address.
+    key : str
+        user id.
+    dir_path : str
+        path to given directory.
+    device : Device
+        current device's Device object.
+    connection_time : int
+        longest wait between attempts to reconnect.
+    rules : Rules, optional
+        what the device syncs down. The default is None, everything.
+
+    Returns
+    -------
+    None.
+
+    """
+    backoff = 1
+    while True:
+        try:
+            # a new connection starts with a round, as on login.
+            if not client:
+                client = connect(server, key, dir_path, device, rules)[0]
+                update(client, device, dir_path)
+                backoff = 1
+            while True:
+                wait(client, device)
+                update(client, device, dir_path)
+        except OSError:
+            if client:
+                client.close()
+            client = None
+            time.sleep(backoff)
+            backoff = min(backoff * 2, max(1, int(connection_time)))
+
+
+def wait(client, device):
+    """
+    waits until the server starts a round, asking it for one once local
+    updates are queued.
+
+    Parameters
+    ----------
+    client : socket
+        client socket.
+    device : Device
+        current device's Device object.
+
+    Returns
+    -------
+    None.
+
+    """
+    waker = device.wake_socket()
+    asked = False
+    while True:
+        # clears wake ups first so none queued after the check is missed.
+        device.clear_wake()
+        if device.has_updates() and not asked:
+            utils.send_token(client, WAKE)
+            client.flush()
+            asked = True
+        # a round may already be buffered, select only sees the socket.
+        if client.pending():
+            return
+        ready = select.select([client, waker], [], [], 2 * HEARTBEAT)[0]
+        # server sends a round at least every HEARTBEAT seconds.
+        if not ready:
+            raise ConnectionError("server stopped responding")
+        if client in ready:
+            return
+
+
+def connect(server, key, path, device=None, rules=None):
     """
-    connects to server.
+    connects to server, or to the node of a cluster serving the user if the
+    server points there.
 
     Parameters
     ----------
@@ -109,6 +230,8 @@ def connect(server, key, path, device=None):
         path to given directory.
     device : Device, optional
         current device's Device object. The default is None.
+    rules : Rules, optional
+        what the device syncs down. The default is None, everything.
 
     Returns
     -------
@@ -120,21 +243,112 @@ def connect(server, key, path, device=None):
         current device's Device object.
 
     """
-    # creates client socket
-    client = socket.create_connection(server)
+    for hop in range(REDIRECTS):
+        # creates client socket
+        client = wire.Channel(socket.create_connection(server))
+        node = hello(client, key, device)
+        if not node:
+            break
+        # streams go to the node too.
+        client.close()
+        server = cluster.split(node)
+    else:
+        raise ConnectionError("pointed through too many nodes")
     # if no key, it's new client - returns new key and 0000 as device num.
     if not key:
         key, device = register(client, path)
     # if no prior device - new device.
     elif not device:
-        device = login(client, key)
-    # else it's an old device.
-    else:
-        login(client, key, device.get_num())
+        device = login(client, path, rules)
+    # agrees on a codec and tells what the device syncs down, then opens the
+    # connections payloads are spread over.
+    client.codec = codec(client)
+    utils.send_json(client, rules.encode() if rules else None)
+    client.streams = streams(client, server, key, device)
     # return connection details.
     return client, key, device
 
 
+def codec(client):
+    # offers the codecs available here, returns the one the server picked.
+    utils.send_json(client, compress.codecs())
+    return utils.receive_json(client)
+
+
+def streams(client, server, key, device, count=STREAMS - 1):
+    """
+    opens further connections to the server for the session.
+
+    Parameters
+    ----------
+    client : Channel
+        the session's connection.
+    server : tuple
+        server's address.
+    key : str
+        user id.
+    device : Device
+        current device's Device object.
+    count : int, optional
+        how many to open. The default is STREAMS - 1.
+
+    Returns
+    -------
+    list
+        the streams, none if the server didn't take all of them.
+
+    """
+    utils.send_size(client, count)
+    client.flush()
+    opened = []
+    try:
+        for i in range(count):
+            stream = wire.Channel(socket.create_connection(server))
+            stream.codec = client.codec
+            opened.append(stream)
+            stream.send(bytes(STREAM + key + device.get_num(), FORMAT))
+            stream.flush()
+    except OSError:
+        pass
+    # the server answers once it has them all or gave up waiting.
+    if utils.receive_file_size(client) < count:
+        for stream in opened:
+            stream.close()
+        return []
+    return opened
+
+
+def hello(client, key, device=None):
+    """
+    asks to register a new user or log into one.
+
+    Parameters
+    ----------
+    client : socket
+        client socket.
+    key : str
+        user id, None for a new user.
+    device : Device, optional
+        current device's Device object. The default is None, a new device.
+
+    Returns
+    -------
+    str
+        the node of a cluster serving the user, "host:port", None if it's
+        the server asked.
+
+    """
+    if not key:
+        # notifies server about new user.
+        client.send(bytes(REGISTER, FORMAT))
+    else:
+        # sends details.
+        client.send(bytes(str(LOGIN), FORMAT))
+        client.send(bytes(str(key), FORMAT))
+        client.send(bytes(str(device.get_num() if device else None), FORMAT))
+    return utils.receive_json(client)
+
+
 def register(client, path):
     """
     registers a new user.
@@ -154,8 +368,6 @@ def register(client, path):
         device object for current console.
 
     """
-    # notifies server about new user.
-    client.send(bytes(REGISTER, FORMAT))
     # receives user's key.
     key = client.recv(ID_SIZE).decode()
     # receives new device's num and creates a new device object.
@@ -166,38 +378,54 @@ def register(client, path):
     return key, device
 
 
-def login(client, key, device_num=None):
+def login(client, path, rules=None):
     """
-    logs into server.
+    logs a new device into server.
 
     Parameters
     ----------
     client : socket.
         client socket.
-    key : str
-        identifier.
-    device_num : str, optional
-        current device's id. The default is None.
+    path : str
+        folder of the new device, reconciled with the server's copy.
+    rules : Rules, optional
+        what the device syncs down. The default is None, everything.
 
     Returns
     -------
-    TYPE
-        DESCRIPTION.
+    device : Device
+        device object for current console.
 
     """
-    # sends details.
-    client.send(bytes(str(LOGIN), FORMAT))
-    client.send(bytes(str(key), FORMAT))
-    client.send(bytes(str(device_num), FORMAT))
-    # if no current device, receives new device and returns created device.
-    if device_num is None:
-        device_num = client.recv(DEVICE_NUM).decode()
-    return utils.Device(device_num)
+    # receives new device and returns created device.
+    device_num = client.recv(DEVICE_NUM).decode()
+    device = utils.Device(device_num)
+    utils.reconcile(client, device, merkle.Tree(path), path, rules)
+    return device
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 5:
-        main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
-    else:
-        main(sys.argv[1], int(sys.argv[2]),
-             sys.argv[3], int(sys.argv[4]), sys.argv[5])
+    parser = argparse.ArgumentParser(description="syncs a folder with the "
+                                     "drive server.")
+    parser.add_argument("ip")
+    parser.add_argument("port", type=int)
+    parser.add_argument("dir")
+    parser.add_argument("time", type=int,
+                        help="seconds between reconnection attempts")
+    parser.add_argument("key", nargs="?",
+                        help="the user's key, for a returning user")
+    parser.add_argument("--lazy", action="store_true",
+                        help="leaves placeholders of the files, downloading "
+                        "each when it's opened")
+    parser.add_argument("--pin", action="append", default=[],
+                        metavar="PATTERN",
+                        help="downloads matching files even when lazy, a "
+                        "trailing / matches a directory's contents")
+    parser.add_argument("--exclude", action="append", default=[],
+                        metavar="PATTERN",
+                        help="doesn't sync matching paths down")
+    args = parser.parse_args()
+    rules = None
+    if args.lazy or args.pin or args.exclude:
+        rules = lazy.Rules(args.lazy, args.pin, args.exclude)
+    main(args.ip, args.port, args.dir, args.time, args.key, rules=rules)
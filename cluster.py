@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Yotam Ben Dov 316387950
+@author: Nili Alfia 314880873
+"""
+
+import bisect
+import hashlib
+import hmac
+import socket
+
+# sizes
+VNODES = 64  # points each node takes on the ring, evening out its share.
+
+
+class Ring:
+    """
+    consistent hash ring of nodes. each node takes VNODES points on a ring of
+    64 bit hashes and a key belongs to the node of the first point at or
+    after the key's hash, so a node joining or leaving only moves the keys
+    between its points and the ones before them, about 1 / nodes of them.
+    """
+
+    def __init__(self, nodes, vnodes=VNODES):
+        """
+        Parameters
+        ----------
+        nodes : iterable
+            addresses of the nodes, as "host:port".
+        vnodes : int, optional
+            points per node. The default is VNODES.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.points = sorted((point(f"{node}#{i}"), node)
+                             for node in nodes for i in range(vnodes))
+        self.hashes = [p for p, node in self.points]
+
+    def owner(self, key):
+        # returns the node owning key, None if there's no node.
+        if not self.points:
+            return None
+        i = bisect.bisect_left(self.hashes, point(key)) % len(self.points)
+        return self.points[i][1]
+
+
+class Cluster:
+    """
+    the nodes a server node shares its users with, listed one "host:port" a
+    line in a file every node reads. nodes join or leave by being added to or
+    removed from the file, which each node rereads on reload.
+    """
+
+    def __init__(self, path, address, secret=None):
+        """
+        Parameters
+        ----------
+        path : str
+            the members file, lines starting with # are skipped.
+        address : str
+            this node's address as listed in the file, "host:port".
+        secret : str, optional
+            shared by the nodes, a node moving a user in proves it knows it.
+            The default is None, nodes are only told apart by address.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.path = path
+        self.address = address
+        self.secret = secret
+        self.nodes = None
+        # every node listed since this one started, a node that left still
+        # moves its users out.
+        self.known = set()
+        self.ring = Ring([])
+        self.reload()
+
+    def reload(self):
+        # rereads the members file, returns True if the members changed.
+        try:
+            with open(self.path) as file:
+                nodes = sorted({line.strip() for line in file
+                                if line.strip() and not line.startswith("#")})
+        except OSError:
+            # a file being rewritten is read on the next reload.
+            return False
+        if nodes == self.nodes:
+            return False
+        self.nodes = nodes
+        self.known.update(nodes)
+        self.ring = Ring(nodes)
+        return True
+
+    def owner(self, key):
+        # returns the address of the node owning a user, this one if alone.
+        return self.ring.owner(key) or self.address
+
+    def owns(self, key):
+        return self.owner(key) == self.address
+
+    def member(self):
+        # checks if this node is listed, a node alone counts as one.
+        return not self.nodes or self.address in self.nodes
+
+    def sign(self, key):
+        # returns this node's proof it may move a user, None without a
+        # secret.
+        return proof(self.secret, self.address, key) if self.secret else None
+
+    def trusts(self, node, key, signature, peer):
+        """
+        checks if a connection moving a user in comes from another node
+        listed now or before, by the address it connects from and, with a
+        secret, the signature it sent.
+
+        Parameters
+        ----------
+        node : str
+            the address the sender says it's listed by.
+        key : str
+            the user moved.
+        signature : str or None
+            what the sender's sign returned.
+        peer : str
+            the host the connection comes from.
+
+        Returns
+        -------
+        bool
+            whether to take the user in.
+
+        """
+        if node not in self.known or node == self.address:
+            return False
+        try:
+            if socket.gethostbyname(split(node)[0]) != peer:
+                return False
+        except (OSError, ValueError):
+            return False
+        if not self.secret:
+            return True
+        return isinstance(signature, str) and \
+            hmac.compare_digest(proof(self.secret, node, key), signature)
+
+
+def point(text):
+    # returns text's place on the ring.
+    return int.from_bytes(hashlib.sha1(text.encode()).digest()[:8], "big")
+
+
+def proof(secret, node, key):
+    # returns the signature of a node moving a user, by the shared secret.
+    return hmac.new(secret.encode(), f"{node}/{key}".encode(),
+                    hashlib.sha256).hexdigest()
+
+
+def split(address):
+    # returns a "host:port" address as a (host, port) tuple.
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
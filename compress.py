@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Yotam Ben Dov 316387950
+@author: Nili Alfia 314880873
+"""
+
+import os
+import zlib
+
+# faster codecs, used when installed.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# sizes
+SAMPLE = 65536  # a file's first bytes, compressed to judge the rest by.
+MIN_SIZE = 1024  # smaller files are sent as they are.
+RATIO = 0.9  # the sample has to shrink to this fraction of its size.
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+PIECE = 1048576  # decompressed data is handed on in pieces of this size.
+
+# miscellaneous
+ZSTD = "zstd"
+LZ4 = "lz4"
+ZLIB = "zlib"
+# formats that are compressed already, never worth another pass.
+SKIP = {
+    ".gz", ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".zip", ".7z", ".rar",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".mp3", ".aac",
+    ".ogg", ".flac", ".mp4", ".mkv", ".mov", ".avi", ".webm", ".pdf",
+    ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".jar", ".apk",
+}
+
+
+class LZ4Compressor:
+    """
+    lz4 frame compressor with the compress/flush interface of zlib's.
+    """
+
+    def __init__(self):
+        self.compressor = lz4.frame.LZ4FrameCompressor()
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        # the frame's header goes out with the first data.
+        header, self.header = self.header, b""
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        return self.header + self.compressor.flush()
+
+
+class Decompressor:
+    """
+    decompressor handing its output on as it's produced, in pieces of at
+    most PIECE bytes, so input that inflates hugely is never held in memory
+    whole and the receiver may stop it as soon as it's had too much.
+    """
+
+    def __init__(self, codec, output):
+        """
+        Parameters
+        ----------
+        codec : str or None
+            the codec the data is compressed with, zlib if None.
+        output : function
+            called with each piece of decompressed data.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.codec = codec
+        self.output = output
+        if codec == ZSTD:
+            # zstandard pushes its output to a writer, one piece at a time.
+            self.unpacker = zstandard.ZstdDecompressor().stream_writer(
+                Sink(output), write_size=PIECE)
+        elif codec == LZ4:
+            self.unpacker = lz4.frame.LZ4FrameDecompressor()
+        else:
+            self.unpacker = zlib.decompressobj()
+
+    def decompress(self, data):
+        # decompresses data, handing the output on.
+        if self.codec == ZSTD:
+            self.unpacker.write(data)
+        elif self.codec == LZ4:
+            piece = self.unpacker.decompress(data, PIECE)
+            self.output(piece)
+            while piece and not self.unpacker.needs_input and \
+                    not self.unpacker.eof:
+                piece = self.unpacker.decompress(b"", PIECE)
+                self.output(piece)
+        else:
+            self.output(self.unpacker.decompress(data, PIECE))
+            while self.unpacker.unconsumed_tail:
+                self.output(self.unpacker.decompress(
+                    self.unpacker.unconsumed_tail, PIECE))
+
+
+class Sink:
+    """
+    writer handing what's written to a function.
+    """
+
+    def __init__(self, output):
+        self.output = output
+
+    def write(self, data):
+        self.output(data)
+        return len(data)
+
+
+def codecs():
+    """
+    returns the codecs this side can use.
+
+    Returns
+    -------
+    list
+        codec names, most preferred first.
+
+    """
+    names = []
+    if zstandard:
+        names.append(ZSTD)
+    if lz4:
+        names.append(LZ4)
+    names.append(ZLIB)
+    return names
+
+
+def choose(offered):
+    # returns the first offered codec this side can use, else None.
+    return next((name for name in offered if name in codecs()), None)
+
+
+def compressor(codec):
+    # returns a new compressor, with compress and flush methods.
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    if codec == LZ4:
+        return LZ4Compressor()
+    return zlib.compressobj(ZLIB_LEVEL)
+
+
+def worth(codec, path):
+    """
+    decides if a file is worth compressing: not too small, not of a
+    compressed format, and its first SAMPLE bytes do shrink.
+
+    Parameters
+    ----------
+    codec : str or None
+        the connection's codec, None if there is none.
+    path : str
+        file's path.
+
+    Returns
+    -------
+    bool
+        True if the file should be sent compressed.
+
+    """
+    if not codec or os.path.splitext(path)[1].lower() in SKIP:
+        return False
+    try:
+        if os.path.getsize(path) < MIN_SIZE:
+            return False
+        with open(path, "rb") as file:
+            sample = file.read(SAMPLE)
+    except OSError:
+        return False
+    return shrinks(codec, sample)
+
+
+def shrinks(codec, sample):
+    # checks if a sample of data shrinks enough to send it compressed.
+    packer = compressor(codec)
+    packed = len(packer.compress(sample)) + len(packer.flush())
+    return packed <= len(sample) * RATIO
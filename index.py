@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Yotam Ben Dov 316387950
+@author: Nili Alfia 314880873
+"""
+
+import os
+import struct
+import threading
+import merkle
+import utils
+from utils import CREATE, MODIFY, DELETE, FORMAT, PARTIAL
+
+# sizes
+DIGEST = 32  # size of a file's content hash.
+COMPACT_MIN = 10000  # log records kept before the index is compacted.
+
+# miscellaneous
+SUFFIX = ".drvindex"  # index of folder f is kept next to it, as .f.drvindex.
+LOG = ".log"  # suffix of the changes made since the index was compacted.
+MAGIC = b"DRVI"
+VERSION = 1
+HEADER = struct.Struct(">4sB128s4s")  # magic, version, user key, device.
+RECORD = struct.Struct(">BQQqI")  # kind, inode, size, mtime, path length.
+
+# record kinds
+FILE = 1  # followed by the content hash, then the path.
+DIRECTORY = 2
+GONE = 3
+
+
+class Index:
+    """
+    state of a synced folder as last sent to or received from the server,
+    kept between runs. each path maps to its inode, size, modification time
+    and, for files, content hash, so a modification that didn't change the
+    content is told apart without reading the file unless its stat changed,
+    and a folder changed while the client was down is rescanned against it
+    with one stat per path. the index is a compact snapshot of records plus
+    a log of the records changed since, both loaded on startup.
+    """
+
+    def __init__(self, folder):
+        """
+        Parameters
+        ----------
+        folder : str
+            the synced folder.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.folder = folder
+        folder = os.path.abspath(folder)
+        self.path = os.path.join(os.path.dirname(folder),
+                                 "." + os.path.basename(folder) + SUFFIX)
+        self.entries = {}  # path -> (kind, inode, size, mtime, hash).
+        # directory -> paths of its entries, a subtree is found without
+        # going over every entry.
+        self.children = {}
+        self.key = self.device = None  # login of the folder's last run.
+        self.count = 0  # records in the log.
+        self.lock = threading.RLock()
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as file:
+                data = file.read()
+            magic, version, key, device = HEADER.unpack_from(data)
+            if magic == MAGIC and version == VERSION:
+                self.key = key.rstrip(b"\0").decode(FORMAT) or None
+                self.device = device.rstrip(b"\0").decode(FORMAT) or None
+                self.load(data, HEADER.size)
+                if os.path.exists(self.path + LOG):
+                    with open(self.path + LOG, "rb") as file:
+                        self.load(file.read(), 0)
+        self.log = None
+        self.compact()
+
+    def load(self, data, pos):
+        # applies the records in data from pos on.
+        while pos + RECORD.size <= len(data):
+            kind, inode, size, mtime, length = RECORD.unpack_from(data, pos)
+            pos += RECORD.size
+            digest = None
+            if kind == FILE:
+                digest = data[pos:pos + DIGEST]
+                pos += DIGEST
+            if pos + length > len(data):
+                # cut short by a crash.
+                break
+            path = data[pos:pos + length].decode(FORMAT)
+            pos += length
+            if kind == GONE:
+                if path in self.entries:
+                    self.drop(path)
+            else:
+                self.put(path, (kind, inode, size, mtime, digest))
+
+    def write(self, path, entry):
+        # appends a record to the log, entry None records path as gone.
+        kind, inode, size, mtime, digest = entry or (GONE, 0, 0, 0, None)
+        data = path.encode(FORMAT)
+        self.log.write(RECORD.pack(kind, inode, size, mtime, len(data)))
+        if kind == FILE:
+            self.log.write(digest)
+        self.log.write(data)
+        self.count += 1
+
+    def compact(self):
+        # writes every entry as a new snapshot and starts an empty log.
+        with self.lock:
+            if self.log:
+                self.log.close()
+            with open(self.path + PARTIAL, "wb") as file:
+                file.write(HEADER.pack(
+                    MAGIC, VERSION, (self.key or "").encode(FORMAT),
+                    (self.device or "").encode(FORMAT)))
+                self.log = file
+                for path, entry in self.entries.items():
+                    self.write(path, entry)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(self.path + PARTIAL, self.path)
+            self.log = open(self.path + LOG, "wb")
+            self.count = 0
+
+    def save(self):
+        # makes the logged records durable, compacts a long log.
+        with self.lock:
+            if self.count > max(COMPACT_MIN, len(self.entries)):
+                self.compact()
+            else:
+                self.log.flush()
+
+    def login(self, key, device):
+        # remembers who the folder is synced as, what was synced for another
+        # user is forgotten.
+        with self.lock:
+            if key != self.key:
+                self.entries = {}
+                self.children = {}
+            if (key, device) != (self.key, self.device):
+                self.key, self.device = key, device
+                self.compact()
+
+    # entries.
+    def put(self, path, entry):
+        # adds or replaces an entry, caller holds the lock.
+        if path not in self.entries:
+            self.children.setdefault(os.path.dirname(path), set()).add(path)
+        self.entries[path] = entry
+
+    def drop(self, path):
+        # forgets an entry, caller holds the lock.
+        del self.entries[path]
+        parent = os.path.dirname(path)
+        self.children[parent].discard(path)
+        if not self.children[parent]:
+            del self.children[parent]
+
+    def subtree(self, path):
+        # returns the paths of path's entry and those of everything in it,
+        # caller holds the lock.
+        paths = [path] if path in self.entries else []
+        stack = [path]
+        while stack:
+            for child in self.children.get(stack.pop(), ()):
+                paths.append(child)
+                stack.append(child)
+        return paths
+
+    def set(self, path, entry):
+        # caller holds the lock.
+        self.put(path, entry)
+        self.write(path, entry)
+
+    def record(self, path):
+        # records what path holds now.
+        full_path = os.path.join(self.folder, path)
+        try:
+            stat = os.stat(full_path)
+            if os.path.isdir(full_path):
+                entry = (DIRECTORY, stat.st_ino, 0, stat.st_mtime_ns, None)
+            else:
+                entry = (FILE, stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                         self.digest(path, stat))
+        except OSError:
+            self.remove(path)
+            return
+        with self.lock:
+            self.set(path, entry)
+
+    def remove(self, path):
+        # forgets path and everything in it.
+        with self.lock:
+            for name in self.subtree(path):
+                self.drop(name)
+                self.write(name, None)
+
+    def move(self, src, dest):
+        # moves src's entry and those of everything in it to dest.
+        with self.lock:
+            self.remove(dest)
+            for name in self.subtree(src):
+                entry = self.entries[name]
+                self.drop(name)
+                self.write(name, None)
+                self.set(dest + name[len(src):], entry)
+
+    def synced(self, command):
+        # records the state an update sent or received left its path in.
+        if command[0] in [CREATE, MODIFY]:
+            self.record(command[1])
+        elif command[0] == DELETE:
+            self.remove(command[1])
+        else:
+            self.move(command[0], command[1])
+
+    # comparing.
+    def digest(self, path, stat):
+        # returns a file's content hash, read only if its stat changed.
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry and entry[0] == FILE and \
+                entry[1:4] == (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            return entry[4]
+        return bytes.fromhex(merkle.file_hash(os.path.join(self.folder, path)))
+
+    def changed(self, path, stat=None):
+        """
+        checks if a file's content changed since it was last synced, a file
+        only touched or rewritten as it was gets its new stat recorded.
+
+        Parameters
+        ----------
+        path : str
+            file's path relative to the folder.
+        stat : os.stat_result, optional
+            the file's stat, if already taken. The default is None.
+
+        Returns
+        -------
+        bool
+            True if the file is new or its content differs.
+
+        """
+        with self.lock:
+            entry = self.entries.get(path)
+        if not entry or entry[0] != FILE:
+            return True
+        try:
+            stat = stat or os.stat(os.path.join(self.folder, path))
+            if entry[1:4] == (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+                return False
+            if stat.st_size != entry[2]:
+                return True
+            digest = self.digest(path, stat)
+        except OSError:
+            return True
+        if digest != entry[4]:
+            return True
+        with self.lock:
+            self.set(path, (FILE, stat.st_ino, stat.st_size,
+                            stat.st_mtime_ns, digest))
+        return False
+
+    def scan(self, device):
+        """
+        queues on a device whatever changed in the folder since it was last
+        synced, for a client that wasn't watching it meanwhile.
+
+        Parameters
+        ----------
+        device : Device
+            the folder's device.
+
+        Returns
+        -------
+        None.
+
+        """
+        seen = set()
+        # directories are queued before their contents.
+        for item, is_dir in utils.walk(self.folder):
+            if utils.is_unsynced(item.name):
+                continue
+            path = os.path.relpath(item.path, self.folder)
+            seen.add(path)
+            with self.lock:
+                entry = self.entries.get(path)
+            if is_dir:
+                if not entry or entry[0] != DIRECTORY:
+                    device.create(path)
+            elif not entry or entry[0] != FILE:
+                device.create(path)
+            elif self.changed(path, item.stat()):
+                device.modify(path)
+        # deletes only the topmost of what's gone.
+        with self.lock:
+            gone = [p for p in self.entries if p not in seen]
+        for path in sorted(gone):
+            if os.path.dirname(path) in seen or not os.path.dirname(path):
+                device.delete(path)
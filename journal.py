@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Yotam Ben Dov 316387950
+@author: Nili Alfia 314880873
+"""
+
+import os
+import json
+import threading
+import utils
+from utils import LOG, CURSOR, TRIM
+
+# sizes
+SNAPSHOT_EVERY = 10000  # journal records between snapshots.
+
+# miscellaneous
+JOURNAL = "journal.{}.log"  # changes of a generation, one per line.
+SNAPSHOT = "snapshot.json"  # compacted state, as of a generation's start.
+
+# records
+USER = "user"
+DEVICE = "device"
+QUEUE = "queue"
+DROP = "drop"  # a user moved to another node.
+
+
+class Journal:
+    """
+    durable server state. every change to users, their devices, change logs
+    and cursors and the devices' own update queues is appended to a journal,
+    and the state is compacted into a snapshot every SNAPSHOT_EVERY records.
+    the journal keeps its own copy of the state, so taking a snapshot never
+    waits on the sessions' locks. each snapshot starts a new generation of
+    the journal, the state is copied and the journal switched under the
+    lock, and the snapshot written outside it.
+    """
+
+    def __init__(self, folder):
+        """
+        Parameters
+        ----------
+        folder : str
+            folder holding the snapshot and journal, created if missing.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.folder = folder
+        # user key -> {"folder": folder, "log": ChangeLog,
+        #              "devices": {num: {"cursor": version, "queue": queue}}}.
+        self.state = {}
+        self.count = 0
+        self.generation = 0  # generation of the journal being written.
+        self.written = 0  # generation of the last snapshot written.
+        self.lock = threading.Lock()
+        # one snapshot is written at a time.
+        self.compacting = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        # recovers from last snapshot and the changes made since.
+        snapshot = os.path.join(folder, SNAPSHOT)
+        if os.path.exists(snapshot):
+            with open(snapshot) as file:
+                data = json.load(file)
+            self.generation = self.written = data["generation"]
+            for key, user in data["users"].items():
+                self.apply([USER, key, user["folder"]])
+                log = utils.ChangeLog(user["start"])
+                self.state[key]["log"] = log
+                for source, command in user["log"]:
+                    log.append(source, tuple(command))
+                for num, device in user["devices"].items():
+                    self.apply([DEVICE, key, num, device["cursor"]])
+                    for command in device["queue"]:
+                        self.apply([QUEUE, key, num, "append", command])
+        # journals of older generations are in the snapshot already.
+        for generation, journal in self.journals():
+            if generation < self.written:
+                continue
+            with open(journal) as file:
+                for line in file:
+                    # a line cut short by a crash is the last one, skips it.
+                    try:
+                        self.apply(json.loads(line))
+                    except ValueError:
+                        break
+            self.generation = generation
+        self.file = None
+        self.snapshot()
+
+    def apply(self, record):
+        # applies a record to the journal's copy of the state.
+        if record[0] == USER:
+            self.state[record[1]] = {
+                "folder": record[2], "log": utils.ChangeLog(), "devices": {}}
+            return
+        if record[0] == DROP:
+            del self.state[record[1]]
+            return
+        user = self.state[record[1]]
+        if record[0] == DEVICE:
+            user["devices"][record[2]] = {
+                "cursor": record[3], "queue": utils.UpdateQueue()}
+        elif record[0] == LOG:
+            user["log"].append(record[2], tuple(record[3]))
+        elif record[0] == CURSOR:
+            user["devices"][record[2]]["cursor"] = record[3]
+        elif record[0] == TRIM:
+            user["log"].trim(record[2])
+        else:
+            queue = user["devices"][record[2]]["queue"]
+            if record[3] == "drain":
+                for i in range(record[4]):
+                    queue.popleft()
+            else:
+                getattr(queue, record[3])(tuple(record[4]))
+
+    def record(self, *record):
+        """
+        applies a change and appends it to the journal.
+
+        Parameters
+        ----------
+        *record : str or list
+            record type followed by its fields.
+
+        Returns
+        -------
+        None.
+
+        """
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.apply(list(record))
+            self.file.write(line)
+            self.file.flush()
+            self.count += 1
+            due = self.count >= SNAPSHOT_EVERY
+            if due:
+                state, generation = self.rotate()
+        # written by the session that filled the journal, others go on.
+        if due:
+            self.compact(state, generation)
+
+    def snapshot(self):
+        # writes the whole state as a snapshot and starts a new journal.
+        with self.lock:
+            state, generation = self.rotate()
+        self.compact(state, generation)
+
+    def rotate(self):
+        # copies the state and starts the next generation's journal, caller
+        # holds the lock. returns the copy and its generation.
+        state = {
+            key: {
+                "folder": user["folder"],
+                "start": user["log"].start,
+                "log": list(user["log"].entries),
+                "devices": {
+                    num: {"cursor": d["cursor"], "queue": list(d["queue"])}
+                    for num, d in user["devices"].items()
+                },
+            }
+            for key, user in self.state.items()
+        }
+        self.generation += 1
+        if self.file:
+            self.file.close()
+        self.file = open(os.path.join(
+            self.folder, JOURNAL.format(self.generation)), "w")
+        self.count = 0
+        return state, self.generation
+
+    def compact(self, state, generation):
+        # writes a copy of the state as the snapshot of its generation, then
+        # drops the journals it holds. a newer snapshot wins.
+        with self.compacting:
+            if generation <= self.written:
+                return
+            snapshot = os.path.join(self.folder, SNAPSHOT)
+            with open(snapshot + utils.PARTIAL, "w") as file:
+                json.dump({"generation": generation, "users": state}, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(snapshot + utils.PARTIAL, snapshot)
+            self.written = generation
+            # only now are the older journals redundant.
+            for older, journal in self.journals():
+                if older < generation:
+                    os.remove(journal)
+
+    def journals(self):
+        # returns (generation, path) of the journals on disk, oldest first.
+        journals = []
+        prefix, suffix = JOURNAL.split("{}")
+        for name in os.listdir(self.folder):
+            number = name[len(prefix):-len(suffix)]
+            if name.startswith(prefix) and name.endswith(suffix) and \
+                    number.isdigit():
+                journals.append((int(number), os.path.join(self.folder, name)))
+        return sorted(journals)
+
+    def track(self, key, device):
+        # journals every change to a device's update queue.
+        num = device.get_num()
+        device.updates.journal = lambda op, command: self.record(
+            QUEUE, key, num, op, command
+        )
+
+    def track_user(self, key, user):
+        # journals every change to a user's change log and cursors.
+        user.journal = lambda *record: self.record(record[0], key, *record[1:])
+
+    def users(self):
+        """
+        rebuilds users with their devices, change logs and pending updates.
+
+        Returns
+        -------
+        users : dict
+            user key -> User, tracked by the journal.
+
+        """
+        users = {}
+        with self.lock:
+            for key, state in self.state.items():
+                user = utils.User(state["folder"])
+                user.log = utils.ChangeLog(state["log"].start)
+                user.log.entries = list(state["log"].entries)
+                user.devices = []
+                for num in sorted(state["devices"]):
+                    device = state["devices"][num]
+                    user.devices.append(
+                        user.own(utils.Device(num), device["cursor"]))
+                    for command in device["queue"]:
+                        user.devices[-1].updates.append(command)
+                user.cur_device = user.devices[0]
+                users[key] = user
+        for key, user in users.items():
+            self.track_user(key, user)
+            for device in user.get_devices():
+                self.track(key, device)
+        return users
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Yotam Ben Dov 316387950
+@author: Nili Alfia 314880873
+"""
+
+import os
+import fnmatch
+
+# miscellaneous
+STUB = ".drvcloud"  # placeholder of file f until it's downloaded is f + STUB.
+TEXT = "placeholder of {}, open this file to download it.\n"
+
+# choices
+DOWNLOAD = "download"
+PLACEHOLDER = "placeholder"
+SKIP = "skip"
+
+
+class Rules:
+    """
+    what a device syncs down. excluded paths aren't synced to it at all,
+    pinned ones are always downloaded and, in lazy mode, every other file
+    is only a placeholder until it's opened. patterns are fnmatch patterns
+    of paths relative to the folder, a trailing "/" matches a directory and
+    everything in it.
+    """
+
+    def __init__(self, lazy=False, pinned=(), excluded=()):
+        """
+        Parameters
+        ----------
+        lazy : bool, optional
+            whether files are placeholders unless pinned. The default is
+            False.
+        pinned : iterable, optional
+            patterns of files downloaded in lazy mode. The default is ().
+        excluded : iterable, optional
+            patterns of paths not synced down. The default is ().
+
+        Returns
+        -------
+        None.
+
+        """
+        self.lazy = lazy
+        self.pinned = list(pinned)
+        self.excluded = list(excluded)
+
+    def encode(self):
+        # returns the rules as sent to the server.
+        return {"lazy": self.lazy, "pinned": self.pinned,
+                "excluded": self.excluded}
+
+    @classmethod
+    def decode(cls, data):
+        # returns rules sent by encode, None if none were.
+        return cls(data["lazy"], data["pinned"], data["excluded"]) \
+            if data else None
+
+    def excludes(self, path):
+        return matches(self.excluded, path)
+
+    def choice(self, path):
+        # returns how a new file at path is synced down.
+        if self.excludes(path):
+            return SKIP
+        if self.lazy and not matches(self.pinned, path):
+            return PLACEHOLDER
+        return DOWNLOAD
+
+
+def matches(patterns, path):
+    # checks if path, or a directory it's in, matches one of patterns.
+    parts = path.split(os.sep)
+    for pattern in patterns:
+        if pattern.endswith("/"):
+            if any(fnmatch.fnmatch(os.sep.join(parts[:i]), pattern[:-1])
+                   for i in range(1, len(parts) + 1)):
+                return True
+        elif fnmatch.fnmatch(path, pattern):
+            return True
+    return False
+
+
+def is_stub(path):
+    # checks if path is a placeholder.
+    return path.endswith(STUB)
+
+
+def create_stub(path):
+    # leaves a placeholder of the file at path.
+    with open(path + STUB, "w") as file:
+        file.write(TEXT.format(os.path.basename(path)))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Yotam Ben Dov 316387950
+@author: Nili Alfia 314880873
+"""
+
+import os
+import hashlib
+import threading
+import utils
+
+# sizes
+READ = 1048576  # files are hashed in reads of this size.
+
+# node types
+FILE = "file"
+DIRECTORY = "fdir"
+
+
+class Node:
+    """
+    node of a merkle tree, a file or a directory of nodes.
+    """
+
+    def __init__(self, kind):
+        """
+        Parameters
+        ----------
+        kind : str
+            FILE or DIRECTORY.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.kind = kind
+        self.hash = None  # None until computed, or once dirty.
+        self.size = self.mtime = None  # state a file's hash was taken at.
+        self.children = {}  # name -> Node, for directories.
+
+
+class Tree:
+    """
+    merkle tree of a folder. a file's hash is its content's, a directory's
+    is taken over its children's names, types and hashes, so two folders
+    holding the same files have the same root hash. hashes are kept between
+    calls, changes are reported through invalidate so that only the changed
+    paths are looked at again.
+    """
+
+    def __init__(self, folder):
+        """
+        Parameters
+        ----------
+        folder : str
+            the folder the tree describes.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.folder = folder
+        self.root = Node(DIRECTORY)
+        self.lock = threading.Lock()
+
+    def invalidate(self, path):
+        # forgets path and the hashes of the directories holding it.
+        with self.lock:
+            node = self.root
+            parts = [p for p in path.split(os.sep) if p]
+            for part in parts[:-1]:
+                node.hash = None
+                node = node.children.get(part)
+                if not node or node.kind != DIRECTORY:
+                    return
+            node.hash = None
+            if parts:
+                node.children.pop(parts[-1], None)
+
+    def listing(self, path):
+        """
+        returns a directory's hash and its children's types and hashes.
+
+        Parameters
+        ----------
+        path : str
+            directory path relative to the folder, "" for the folder itself.
+
+        Returns
+        -------
+        dict or None
+            {"hash": hash, "children": {name: [type, hash]}}, None if path
+            is not a directory.
+
+        """
+        with self.lock:
+            node, current = self.root, self.folder
+            for part in [p for p in path.split(os.sep) if p]:
+                self.compute(node, current)
+                node = node.children.get(part)
+                current = os.path.join(current, part)
+                if not node:
+                    return None
+            if node.kind != DIRECTORY:
+                return None
+            self.compute(node, current)
+            return {
+                "hash": node.hash,
+                "children": {
+                    name: [child.kind, child.hash]
+                    for name, child in node.children.items()
+                },
+            }
+
+    def compute(self, node, path):
+        # brings node's hash up to date, caller holds the lock.
+        if node.kind == FILE:
+            stat = os.stat(path)
+            if (stat.st_size, stat.st_mtime_ns) != (node.size, node.mtime):
+                node.hash = file_hash(path)
+                node.size, node.mtime = stat.st_size, stat.st_mtime_ns
+            return
+        if node.hash:
+            return
+        # walks down the directories, children are hashed before parents.
+        stack = [(node, path, False)]
+        while stack:
+            node, path, done = stack.pop()
+            if done:
+                node.hash = dir_hash(node)
+                continue
+            stack.append((node, path, True))
+            seen = set()
+            with os.scandir(path) as fdir:
+                for entry in fdir:
+                    if utils.is_unsynced(entry.name):
+                        continue
+                    seen.add(entry.name)
+                    kind = DIRECTORY if entry.is_dir() else FILE
+                    child = node.children.get(entry.name)
+                    if not child or child.kind != kind:
+                        child = node.children[entry.name] = Node(kind)
+                    if kind == FILE:
+                        self.compute(child, entry.path)
+                    elif not child.hash:
+                        stack.append((child, entry.path, False))
+            for name in list(node.children):
+                if name not in seen:
+                    del node.children[name]
+
+    def root_hash(self):
+        # returns hash of the whole folder.
+        return self.listing("")["hash"]
+
+
+def file_hash(path):
+    # returns hash of a file's content.
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for data in iter(lambda: file.read(READ), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def dir_hash(node):
+    # returns hash of a directory from its children's.
+    digest = hashlib.sha256()
+    for name in sorted(node.children):
+        child = node.children[name]
+        digest.update(f"{name}\0{child.kind}\0{child.hash}\n".encode())
+    return digest.hexdigest()
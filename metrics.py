@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Yotam Ben Dov 316387950
+@author: Nili Alfia 314880873
+"""
+
+import time
+import threading
+import functools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# miscellaneous
+# upper bounds of histogram buckets, in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300,
+           float("inf"))
+CONTENT_TYPE = "text/plain; version=0.0.4"
+PATH = "/metrics"
+
+registry = []  # every metric, in the order they're exposed.
+
+
+class Metric:
+    """
+    a named metric with a value per combination of label values.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, description, labels=()):
+        """
+        Parameters
+        ----------
+        name : str
+            exposed name.
+        description : str
+            one line description.
+        labels : tuple, optional
+            names of the labels values are kept per. The default is ().
+
+        Returns
+        -------
+        None.
+
+        """
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}  # label values -> value.
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def label(self, values, extra=()):
+        # formats label values, with extra (name, value) pairs, as {...}.
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape(value)}"'
+                              for name, value in pairs) + "}"
+
+    def samples(self):
+        # returns the lines exposing the metric's values.
+        with self.lock:
+            values = dict(self.values)
+        return [f"{self.name}{self.label(k)} {v}" for k, v in values.items()]
+
+    def render(self):
+        return [f"# HELP {self.name} {self.description}",
+                f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+
+class Counter(Metric):
+    """
+    a total that only grows, like bytes sent.
+    """
+
+    kind = "counter"
+
+    def add(self, amount, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def time(self, *labels):
+        # returns a context manager adding the seconds spent in it.
+        return Timer(self.add, labels)
+
+
+class Gauge(Metric):
+    """
+    a value read when exposed, from a function returning label values ->
+    value.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, description, labels=(), collect=None):
+        super().__init__(name, description, labels)
+        self.collect = collect
+
+    def samples(self):
+        if self.collect:
+            with self.lock:
+                self.values = self.collect()
+        return super().samples()
+
+
+class Histogram(Metric):
+    """
+    a distribution of durations, counted into BUCKETS.
+    """
+
+    kind = "histogram"
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if not counts:
+                # bucket counts, then sum and count.
+                counts = self.values[labels] = [0] * len(BUCKETS) + [0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def time(self, *labels):
+        # returns a context manager observing the seconds spent in it.
+        return Timer(self.observe, labels)
+
+    def timed(self, *labels):
+        # decorates a function to observe how long each call takes.
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.time(*labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def samples(self):
+        with self.lock:
+            values = {k: list(v) for k, v in self.values.items()}
+        lines = []
+        for labels, counts in values.items():
+            total = 0
+            for bound, count in zip(BUCKETS, counts):
+                total += count
+                bound = "+Inf" if bound == float("inf") else bound
+                lines.append(f"{self.name}_bucket"
+                             f"{self.label(labels, [('le', bound)])} {total}")
+            lines.append(f"{self.name}_sum{self.label(labels)} {counts[-2]}")
+            lines.append(f"{self.name}_count{self.label(labels)} {counts[-1]}")
+        return lines
+
+
+class Timer:
+    """
+    context manager reporting the seconds spent in it.
+    """
+
+    def __init__(self, report, labels):
+        self.report = report
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.report(time.perf_counter() - self.start, *self.labels)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    serves the metrics in prometheus' text format.
+    """
+
+    def do_GET(self):
+        if self.path != PATH:
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes aren't logged.
+        pass
+
+
+def escape(value):
+    # escapes a label value.
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def render():
+    # returns every metric in prometheus' text format.
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def serve(port, host="127.0.0.1"):
+    """
+    exposes the metrics at http://host:port/metrics, from a daemon thread.
+
+    Parameters
+    ----------
+    port : int
+        port to listen on.
+    host : str, optional
+        address to listen on, local only by default. The default is
+        "127.0.0.1".
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        the running http server.
+
+    """
+    server = ThreadingHTTPServer((host, int(port)), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# the metrics kept by the server, client processes keep them too but never
+# expose them.
+BYTES = Counter("drive_bytes_total",
+                "bytes sent and received, frame headers included.",
+                ("direction",))
+OPERATIONS = Counter("drive_operations_total",
+                     "updates sent and applied, per action.",
+                     ("direction", "action"))
+IO_SECONDS = Counter("drive_io_seconds_total",
+                     "seconds spent in socket calls and in file reads and "
+                     "writes.", ("kind",))
+PHASES = Histogram("drive_phase_seconds",
+                   "seconds spent per call of a session's phases.",
+                   ("phase",))
+TRANSFERS = Histogram("drive_transfer_seconds",
+                      "seconds spent sending or receiving a single file.",
+                      ("direction",))
+SESSIONS = Histogram("drive_session_seconds",
+                     "seconds from a client's connection to its close.")
+QUEUE = Gauge("drive_queue_depth",
+              "updates waiting to be sent to each device.",
+              ("user", "device"))
+
+
+def network():
+    # times socket calls.
+    return IO_SECONDS.time("network")
+
+
+def disk():
+    # times file reads and writes.
+    return IO_SECONDS.time("disk")
@@ -4,8 +4,22 @@
 @author: Yotam Ben Dov 316387950
 @author: Nili Alfia 314880873
 """
-import sys, os, random, string, socket
+import sys, os, random, string, socket, threading, select, time, cProfile
+import argparse
+import tempfile
+import multiprocessing
+import itertools
+import struct
+import zlib
 import utils
+import store
+import wire
+import merkle
+import compress
+import metrics
+import cluster
+import lazy
+from journal import Journal, USER, DEVICE, DROP
 
 # sizes
 TYPE = 4  # file type (file or directory).
@@ -15,13 +29,25 @@ PATH_LEN = 8  # path's length shouldn't be over 10^8.
 FILE_SIZE = 16  # maximum file size at 10^16.
 ID_SIZE = 128  # default size of login key.
 CHUNK = 4096  # a moderate chunk of data.
+WORKERS = 64  # update rounds served at once.
+STREAM_WAIT = 10  # seconds a session waits for its client's streams.
+STORE = "store"  # folder of the deduplicating block store.
+STATE = "state"  # folder of the journal users and devices are kept in.
+PROFILES = "profiles"  # folder of profiled sessions' stats.
+HANDOFF_SIZE = 262144  # longest message handing a connection to a worker.
+SHARDS = "shards"  # file holding how many processes users are sharded over.
 
 # miscellaneous
 FORMAT = "UTF-8"  # encoding format used.
 LOGIN = "signin"
 REGISTER = "signup"
+STREAM = "stream"  # opens another connection for a device's session.
+IMPORT = "import"  # moves a user in from another node of the cluster.
 DONE = "done"
 UPDONE = "updone"
+HEARTBEAT = 30  # seconds between rounds on an idle kept connection.
+HANDOFF = struct.Struct(">I")  # handed over connection's frame bytes left.
+CLUSTER_CHECK = 5  # seconds between reads of the cluster's members.
 CHARS = string.ascii_letters + string.digits  # list of possible digits for id.
 
 # file types
@@ -35,9 +61,21 @@ DELETE = "delete"
 MODIFY = "modify"
 
 users = {}
-
-
-def main(port_num):
+users_lock = threading.Lock()  # guards users dict and folder numbering.
+blocks = None  # block store shared by all users, opened by main.
+rounds = None  # bounds update rounds running at once, set by main.
+journal = None  # durable copy of users and their devices, opened by main.
+profile_rate = 0  # share of sessions profiled, set by main.
+limit = None  # bandwidth limit users share, set by main if any.
+shard_of = None  # (index, count) of a worker process, None if there's one.
+nodes = None  # the cluster this node is in, None if it's alone.
+moves = threading.Condition()  # guards moving and running.
+moving = set()  # users being moved to another node, served no more rounds.
+running = {}  # user -> rounds of the user's running.
+
+
+def main(port_num, workers=WORKERS, metrics_port=None, profile=0,
+         processes=1, members=None, address=None, rate=None, secret=None):
     """
     the main function of the cloud server.
 
@@ -45,31 +83,452 @@ def main(port_num):
     ----------
     port_num : int
         the desired port to which the server will try to bind.
+    workers : int, optional
+        how many update rounds are served concurrently. The default is
+        WORKERS.
+    metrics_port : int, optional
+        local port metrics are exposed on, at /metrics, none if not given.
+        The default is None.
+    profile : float, optional
+        share of sessions run under cProfile, their stats are dumped into
+        PROFILES. The default is 0.
+    processes : int, optional
+        worker processes users are sharded over, see front. The default is
+        1, a single process serving everyone.
+    members : str, optional
+        file listing the nodes of a cluster this node is in, see
+        cluster.Cluster. users are spread over the nodes by consistent
+        hashing of their keys, clients of a user are pointed to its node and
+        users are moved when nodes join or leave. The default is None, no
+        cluster.
+    address : str, optional
+        this node's "host:port" as listed in members. The default is
+        "127.0.0.1:port_num".
+    rate : float, optional
+        bytes a second the server sends and receives at most, shared evenly
+        by the users transferring at the moment, see wire.Limit. worker
+        processes get an even share each. The default is None, no limit.
+    secret : str, optional
+        shared by the nodes of the cluster, users are only moved in by nodes
+        that know it. The default is None, any listed node may.
 
     Returns
     -------
     None.
 
     """
+    if members:
+        members = (members, address or f"127.0.0.1:{port_num}", secret)
+    layout(processes)
+    if processes > 1:
+        front(port_num, processes, workers, metrics_port, profile, members,
+              rate / processes if rate else None)
+        return
+    start(workers, metrics_port, profile, members, rate)
     # creates server and starts listening to clients.
     server = socket.create_server(("", int(port_num)))
     server.listen()
-    # gets current directory.
-    default_dir = os.getcwd()
-    # while receiving clients.
+    # while receiving clients, serves each in its own thread, idle kept
+    # connections only wait in select so they hold no round.
+    while True:
+        client = server.accept()[0]
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        client = wire.Channel(client)
+        threading.Thread(target=session, args=(client,), daemon=True).start()
+
+
+def layout(processes):
+    """
+    records how many processes the server's users are sharded over, in the
+    current folder. a user is owned by the worker its key hashes to, out of
+    all of them, and kept in that worker's folder, so the server only ever
+    runs with the count its users were placed with.
+
+    Parameters
+    ----------
+    processes : int
+        worker processes the server is started with, 1 for a single one.
+
+    Raises
+    ------
+    ValueError
+        if the folder holds users sharded over another count.
+
+    Returns
+    -------
+    None.
+
+    """
+    if os.path.exists(SHARDS):
+        with open(SHARDS) as file:
+            count = int(file.read())
+    else:
+        # a folder served before the count was recorded goes by its folders.
+        if os.path.exists(STATE):
+            count = 1
+        else:
+            count = len([name for name in os.listdir(".") if name.startswith(
+                "shard") and name[len("shard"):].isdigit()]) or processes
+        with open(SHARDS + ".tmp", "w") as file:
+            file.write(str(count))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(SHARDS + ".tmp", SHARDS)
+    if count != processes:
+        raise ValueError(f"users here are sharded over {count} processes, "
+                         f"the server can't run with {processes}")
+
+
+def start(workers, metrics_port, profile, members, rate):
+    # opens the state a serving process keeps, in the current folder.
+    global blocks, rounds, journal, profile_rate, nodes, limit
+    # opens the block store user files are deduplicated in.
+    blocks = store.Store(STORE)
+    # recovers users, devices and pending updates from before a restart.
+    journal = Journal(STATE)
+    users.update(journal.users())
+    rounds = threading.BoundedSemaphore(workers)
+    profile_rate = profile
+    if rate:
+        limit = wire.Limit(rate)
+    if metrics_port:
+        metrics.QUEUE.collect = queue_depths
+        metrics.serve(metrics_port)
+    # joins the cluster, moving away users other nodes own from then on.
+    if members:
+        nodes = cluster.Cluster(*members)
+        threading.Thread(target=rebalance, daemon=True).start()
+
+
+def front(port_num, processes, workers, metrics_port, profile, members,
+          rate):
+    """
+    runs the server as a front process and worker processes, each owning
+    the users whose key it's the owner of, so a user's state is only ever
+    touched by one process and needs no locks across processes. the front
+    only reads which user a connection is for and hands the connection
+    over to the owner, passing the socket itself over a unix socket. each
+    worker keeps its store, state and user folders in a folder of its own,
+    shard<index>. unix only.
+
+    Parameters
+    ----------
+    port_num : int
+        the desired port to which the server will try to bind.
+    processes : int
+        number of worker processes.
+    workers : int
+        update rounds each worker serves concurrently.
+    metrics_port : int or None
+        each worker exposes its metrics on this port plus its index.
+    profile : float
+        share of sessions run under cProfile.
+    members : tuple or None
+        members file, address and secret of the cluster the node is in, if
+        any.
+    rate : float or None
+        bandwidth limit of each worker.
+
+    Returns
+    -------
+    None.
+
+    """
+    shards = []
+    # workers are forked before the front starts any thread.
+    for index in range(processes):
+        parent, child = socket.socketpair(socket.AF_UNIX,
+                                          socket.SOCK_SEQPACKET)
+        multiprocessing.Process(target=shard_main, args=(
+            index, processes, child, [parent] + [s[0] for s in shards],
+            workers, metrics_port + index if metrics_port else None,
+            profile, members, rate)).start()
+        child.close()
+        shards.append((parent, threading.Lock()))
+    server = socket.create_server(("", int(port_num)))
+    server.listen()
+    turns = itertools.count()
+    while True:
+        client = server.accept()[0]
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        threading.Thread(target=route, args=(client, shards, turns),
+                         daemon=True).start()
+
+
+def route(sock, shards, turns):
+    """
+    hands a connection over to the worker owning its user, new users are
+    spread over the workers in turn.
+
+    Parameters
+    ----------
+    sock : socket
+        the connection, closed in the front once handed over.
+    shards : list
+        (unix socket, its lock) of each worker.
+    turns : iterator
+        counts new users, shared by all connections.
+
+    Returns
+    -------
+    None.
+
+    """
+    client = wire.Channel(sock)
+    try:
+        # the worker reads what the front did all over again.
+        read = client.recv(ACTION)
+        if read.decode() == REGISTER:
+            index = next(turns) % len(shards)
+        else:
+            key = client.recv(ID_SIZE)
+            read += key
+            index = owner(key.decode(), len(shards))
+        buffered, left = client.handoff(read)
+        shard, lock = shards[index]
+        with lock:
+            socket.send_fds(shard, [HANDOFF.pack(left) + buffered],
+                            [sock.fileno()])
+    except (OSError, UnicodeDecodeError):
+        pass
+    finally:
+        sock.close()
+
+
+def shard_main(index, count, shard, fronts, workers, metrics_port, profile,
+               members, rate):
+    """
+    a worker process, serving the connections the front hands over.
+
+    Parameters
+    ----------
+    index : int
+        the worker's index.
+    count : int
+        number of workers.
+    shard : socket
+        unix socket connections are handed over on.
+    fronts : list
+        the front's ends of the unix sockets, inherited and closed so the
+        worker exits along with the front.
+    workers : int
+        update rounds served concurrently.
+    metrics_port : int or None
+        local port metrics are exposed on.
+    profile : float
+        share of sessions run under cProfile.
+    members : tuple or None
+        members file, address and secret of the cluster the node is in, if
+        any.
+    rate : float or None
+        bandwidth limit of the worker.
+
+    Returns
+    -------
+    None.
+
+    """
+    global shard_of
+    shard_of = (index, count)
+    for sock in fronts:
+        sock.close()
+    os.makedirs(f"shard{index}", exist_ok=True)
+    os.chdir(f"shard{index}")
+    start(workers, metrics_port, profile, members, rate)
+    while True:
+        data, fds = socket.recv_fds(shard, HANDOFF_SIZE, 1)[:2]
+        # the front is gone.
+        if not data:
+            return
+        sock = socket.socket(fileno=fds[0])
+        client = wire.Channel(sock, data[HANDOFF.size:],
+                              HANDOFF.unpack_from(data)[0])
+        threading.Thread(target=session, args=(client,), daemon=True).start()
+
+
+def owner(key, count):
+    # returns the index of the worker owning a user.
+    return zlib.crc32(key.encode()) % count
+
+
+def mine(key):
+    # checks if this process owns a user, of its node's workers and nodes.
+    return (not shard_of or owner(key, shard_of[1]) == shard_of[0]) and \
+        (not nodes or nodes.owns(key))
+
+
+def session(client):
+    """
+    serves a single connected client from login to disconnection. a client
+    that stays connected after the first round gets its updates pushed.
+
+    Parameters
+    ----------
+    client : socket
+        client socket.
+
+    Returns
+    -------
+    None.
+
+    """
+    kept = False
+    device = None
+    start = time.monotonic()
+    profiler = None
+    if random.random() < profile_rate:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        # connects to client device and updates files.
+        with rounds:
+            user, device = connect(client)
+        # a stream is kept for its device's session, a client pointed to
+        # another node or a user moved in is done with.
+        if not user:
+            kept = device is not None
+            return
+        # a device that reconnects is served by this session from now on.
+        supersede(client, device)
+        # the user's connections share its part of the bandwidth limit.
+        if limit:
+            client.share = limit.share(user)
+        client.codec = codec(client)
+        # what the device syncs down.
+        device.rules = lazy.Rules.decode(utils.receive_json(client))
+        # waits for the streams holding no round, they need one to attach.
+        client.streams = streams(client, device)
+        # runs another round whenever either side has something new, until
+        # the user moves to another node and its client has to reconnect.
+        if turn(client, user, device):
+            while wait(client, device) and turn(client, user, device):
+                pass
+    finally:
+        if not kept:
+            if device:
+                with device.lock:
+                    if device.session is client:
+                        device.session = None
+            client.close()
+            metrics.SESSIONS.observe(time.monotonic() - start)
+        if profiler:
+            profiler.disable()
+            os.makedirs(PROFILES, exist_ok=True)
+            profiler.dump_stats(os.path.join(
+                PROFILES, f"session-{time.time():.0f}-{id(client)}.prof"))
+
+
+def supersede(client, device):
+    """
+    makes a session the device's current one. the one it replaces, likely
+    on a connection that died without a word, stops waiting and has its
+    connection shut down, so a round it's in fails at once.
+
+    Parameters
+    ----------
+    client : Channel
+        client connection of the new session.
+    device : Device
+        the client's device.
+
+    Returns
+    -------
+    None.
+
+    """
+    with device.lock:
+        old, device.session = device.session, client
+    if old:
+        try:
+            old.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    device.notify()
+
+
+def wait(client, device):
+    """
+    waits until the device has updates queued, the client asks for a round
+    or the connection has been idle for HEARTBEAT seconds.
+
+    Parameters
+    ----------
+    client : socket
+        client socket.
+    device : Device
+        the client's device.
+
+    Returns
+    -------
+    bool
+        True if a round should run, False if the client disconnected or
+        reconnected on another session.
+
+    """
+    waker = device.wake_socket()
     while True:
-        # connects to client device.
-        user, client = connect(server)
-        # prepares for updates.
-        os.chdir(user.get_folder())
-        # updates files.
-        update(client, user)
-        # reverts to original server directory and closes client.
-        os.chdir(default_dir)
-        client.close()
+        # clears wake ups first so none queued after the check is missed.
+        device.clear_wake()
+        if device.session is not client:
+            return False
+        if device.has_updates() or device.owner in moving:
+            return True
+        # a wake up may already be buffered, select only sees the socket.
+        if client.pending():
+            ready = [client]
+        else:
+            ready = select.select([client, waker], [], [], HEARTBEAT)[0]
+        if not ready:
+            return True
+        if client in ready:
+            # the only thing a client sends between rounds is a wake up.
+            try:
+                utils.receive_token(client)
+            except ConnectionError:
+                return False
+            return True
+
+
+def turn(client, user, device):
+    """
+    runs a round, unless the user is moving to another node.
 
+    Parameters
+    ----------
+    client : socket
+        client socket.
+    user : User
+        user object.
+    device : Device
+        the client's device.
 
-def update(client, user):
+    Returns
+    -------
+    bool
+        False if the user is moving or the device reconnected on another
+        session, and no round ran.
+
+    """
+    with moves:
+        if user in moving:
+            return False
+        running[user] = running.get(user, 0) + 1
+    try:
+        # waits out a round of the session this one replaced.
+        with device.running:
+            if device.session is not client:
+                return False
+            with rounds:
+                update(client, user, device)
+    finally:
+        with moves:
+            running[user] -= 1
+            moves.notify_all()
+    return True
+
+
+@metrics.PHASES.timed("update")
+def update(client, user, device=None):
     """
     updates server and relevant user devices.
 
@@ -79,48 +538,61 @@ def update(client, user):
         client socket.
     user : User
         user object.
+    device : Device, optional
+        the connected device. The default is the user's current device.
 
     Returns
     -------
     None.
 
     """
+    if not device:
+        device = user.get_device()
+    # paths are resolved against the user's folder, not the process cwd.
+    folder = user.get_folder()
+    # a device whose changes were dropped from the log gets everything.
+    if user.lagging(device):
+        user.resync(device)
+        utils.upload_all(device, folder, folder)
     # sends updates and then receives updates from client.
-    utils.send_updates(client, user.get_device())
-    utils.receive_updates(client, user.get_device(), user)
+    utils.send_updates(client, device, base=folder)
+    # one device's updates at a time, a file two of them send at once would
+    # be received into the same checkpoint.
+    with user.applying:
+        utils.receive_updates(client, device, user, base=folder,
+                              store=blocks)
 
 
-def connect(server):
+@metrics.PHASES.timed("connect")
+def connect(client):
     """
-    connects server to client.
+    identifies a connected client.
 
     Parameters
     ----------
-    server : socket
-        server socket.
+    client : socket
+        client socket.
 
     Returns
     -------
     user : User
-        user object.
-    client : socket
-        client socket.
+        user object, None for a stream, a client pointed to another node and
+        a user moved in.
+    device : Device
+        the client's device, the stream's device for a stream.
 
     """
-    # accept client
-    client = server.accept()[0]
     # check if login or register
     action = client.recv(ACTION).decode()
     # according to given action, registers a new user or logs in and old one.
     if action == REGISTER:
-        user = register(client)
-    else:
-        user = login(client)
-    device_num = user.get_dev_num()
-    # set given device num as current device.
-    user.set_device(device_num)
-    # returns User object, appropriate device and connected client.
-    return user, client
+        return register(client)
+    if action == STREAM:
+        return None, attach(client)
+    if action == IMPORT:
+        arrive(client)
+        return None, None
+    return login(client)
 
 
 def login(client):
@@ -135,26 +607,34 @@ def login(client):
     Returns
     -------
     user : User
-        relevant user to the logged in client.
+        relevant user to the logged in client, None if it's on another node.
+    device : Device
+        the client's device.
 
     """
-    # receives key.
+    # receives key and device num.
     key = client.recv(ID_SIZE).decode()
-    # gets user.
-    user = users[key]
-    # receives device num from client.
     device_num = client.recv(DEVICE_NUM).decode()
+    # gets user, a user on another node has its client pointed there.
+    with users_lock:
+        user = users.get(key)
+    with moves:
+        here = user is not None and user not in moving
+    if not here and nodes and not nodes.owns(key):
+        utils.send_json(client, nodes.owner(key))
+        client.flush()
+        return None, None
+    if not here:
+        raise KeyError(f"no user {key}")
+    utils.send_json(client, None)
     # if doesn't have one, assigns a new one and send it to client.
     if device_num == "None":
-        device_num = user.add_device()
+        device_num = user.add_device(lambda device: track(key, device))
         client.send(bytes(device_num, FORMAT))
-        # adds all file in folder to be uploaded.
-        utils.upload_all(
-            user.get_device(device_num), user.get_folder(), user.get_folder()
-        )
-    # sets as current device.
-    user.set_device(device_num)
-    return user
+        # queues whatever the device's folder is missing.
+        utils.serve_reconcile(client, user.get_device(device_num),
+                              tree(user), user.get_folder())
+    return user, user.get_device(device_num)
 
 
 def register(client):
@@ -168,27 +648,309 @@ def register(client):
 
     Returns
     -------
-    users[key] : User
+    user : User
         new user object.
+    device : Device
+        the client's device.
 
     """
-    # create new key for user, create folder.
+    # a node that left its cluster points new users to one still in it.
+    if nodes and not nodes.member():
+        utils.send_json(client, nodes.owner(""))
+        client.flush()
+        return None, None
+    utils.send_json(client, None)
+    # create new key for user, one this worker owns, create folder.
     key = "".join(random.choice(CHARS) for c in range(ID_SIZE))
-    user_folder = f"user{len(users)}"
-    # tries to create a folder, if exists deletes and tries again.
-    try:
+    while not mine(key):
+        key = "".join(random.choice(CHARS) for c in range(ID_SIZE))
+    with users_lock:
+        user_folder = new_folder()
         os.mkdir(user_folder)
-    except:
-        utils.delete_dir(user_folder, user_folder)
-        os.mkdir(user_folder)
-    # insert new User into user dictionary.
-    users[key] = utils.User(user_folder)
+        # insert new User into user dictionary.
+        user = users[key] = utils.User(user_folder)
+        journal.record(USER, key, user_folder)
+        journal.track_user(key, user)
+        track(key, user.get_device())
     # send key and device num to client.
     client.send(bytes(key, FORMAT))
     print(key)
-    client.send(bytes(str(users[key].get_device().get_num()), FORMAT))
-    return users[key]
+    client.send(bytes(str(user.get_device().get_num()), FORMAT))
+    return user, user.get_device()
+
+
+def attach(client):
+    """
+    attaches a stream to the device that opened it.
+
+    Parameters
+    ----------
+    client : Channel
+        the stream.
+
+    Returns
+    -------
+    Device
+        the device.
+
+    """
+    key = client.recv(ID_SIZE).decode()
+    device_num = client.recv(DEVICE_NUM).decode()
+    with users_lock:
+        user = users[key]
+    device = user.get_device(device_num)
+    device.attach(client)
+    return device
+
+
+def new_folder():
+    # returns a folder name no user has, clearing what a crash left there.
+    # caller holds users_lock.
+    used = {user.get_folder() for user in users.values()}
+    number = len(users)
+    while f"user{number}" in used:
+        number += 1
+    user_folder = f"user{number}"
+    if os.path.exists(user_folder):
+        utils.delete_dir(user_folder, user_folder)
+    return user_folder
+
+
+def rebalance():
+    # moves away the users another node owns, checking whenever the members
+    # may have changed. a move that fails is tried again on the next check.
+    while True:
+        time.sleep(CLUSTER_CHECK)
+        nodes.reload()
+        with users_lock:
+            leaving = [(key, user) for key, user in users.items()
+                       if not nodes.owns(key)]
+        for key, user in leaving:
+            address = nodes.owner(key)
+            try:
+                move(key, user, address)
+            except (OSError, ValueError) as error:
+                print(f"moving a user to {address} failed: {error}",
+                      file=sys.stderr)
+
+
+def move(key, user, address):
+    """
+    moves a user to another node: stops serving it, sends the node what each
+    device wasn't sent yet and the user's folder, then forgets it. the user's
+    clients are closed and reconnect to the node they're pointed to.
+
+    Parameters
+    ----------
+    key : str
+        user id.
+    user : User
+        the user.
+    address : str
+        the node taking the user, "host:port".
+
+    Returns
+    -------
+    None.
+
+    """
+    # waits for the rounds running to end, new ones end their sessions.
+    with moves:
+        moving.add(user)
+        moves.wait_for(lambda: not running.get(user))
+    for device in user.get_devices():
+        device.notify()
+    folder = user.get_folder()
+    try:
+        node = wire.Channel(socket.create_connection(cluster.split(address)))
+        try:
+            node.send(bytes(IMPORT + key, FORMAT))
+            utils.send_json(node, {"node": nodes.address,
+                                   "signature": nodes.sign(key)})
+            utils.send_json(node, unsent(user))
+            # the folder is sent as one device's creates, offered as hashes.
+            sender = utils.Device("0000")
+            utils.upload_all(sender, folder, folder)
+            utils.send_updates(node, sender, base=folder, dedup=True)
+            # the node answers once it journaled the user.
+            utils.receive_token(node)
+        finally:
+            node.close()
+    except BaseException:
+        with moves:
+            moving.discard(user)
+        raise
+    with users_lock:
+        del users[key]
+        journal.record(DROP, key)
+    with moves:
+        moving.discard(user)
+        running.pop(user, None)
+    utils.delete_dir(folder, folder)
+
+
+def unsent(user):
+    # returns device num -> commands the device wasn't sent yet, its own
+    # queue's then the logged ones, None for a device too far behind.
+    with user.lock:
+        log = user.log
+        commands = {}
+        for device in user.devices:
+            num = device.get_num()
+            if device.cursor < log.start - 1:
+                commands[num] = None
+                continue
+            commands[num] = [list(command) for command in device.updates]
+            for version in range(device.cursor + 1, log.head() + 1):
+                source, command = log.get(version)
+                if source != num:
+                    commands[num].append(list(command))
+        return commands
+
+
+def arrive(client):
+    """
+    takes in a user moved from another node, its devices keep their numbers
+    and are sent what they weren't on the old node.
+
+    Parameters
+    ----------
+    client : Channel
+        connection from the node the user moves from.
+
+    Returns
+    -------
+    None.
+
+    """
+    key = client.recv(ID_SIZE).decode()
+    # only another node of the cluster moves users in, and only ours.
+    sender = utils.receive_json(client)
+    if not nodes:
+        raise ValueError("a user was moved in to a node not in a cluster")
+    nodes.reload()
+    if not isinstance(sender, dict) or not nodes.trusts(
+            sender.get("node"), key, sender.get("signature"),
+            client.sock.getpeername()[0]):
+        raise ValueError("a user was moved in by a node not in the cluster")
+    if not mine(key):
+        raise ValueError(f"user {key} was moved in but isn't ours")
+    commands = utils.receive_json(client)
+    with users_lock:
+        if key in users:
+            raise ValueError(f"user {key} is already here")
+    # the folder is received aside, the user is only served once it's in.
+    temp = tempfile.mkdtemp(prefix=IMPORT, dir=".")
+    try:
+        utils.receive_updates(client, utils.Device("0000"), base=temp,
+                              store=blocks)
+        with users_lock:
+            user_folder = new_folder()
+            os.rename(temp, user_folder)
+            user = users[key] = utils.User(user_folder)
+            journal.record(USER, key, user_folder)
+            journal.track_user(key, user)
+            track(key, user.get_device())
+            while len(user.get_devices()) < len(commands):
+                user.add_device(lambda device: track(key, device))
+            for device in user.get_devices():
+                if commands[device.get_num()] is None:
+                    utils.upload_all(device, user_folder, user_folder)
+                    continue
+                for command in commands[device.get_num()]:
+                    device.updates.append(tuple(command))
+    except BaseException:
+        if os.path.exists(temp):
+            utils.delete_dir(temp, temp)
+        raise
+    utils.send_token(client, DONE)
+    client.flush()
+
+
+def codec(client):
+    # picks the first codec the client offers that's available here.
+    choice = compress.choose(utils.receive_json(client))
+    utils.send_json(client, choice)
+    return choice
+
+
+def streams(client, device):
+    """
+    takes the streams the client opens for its session, all of them or, if
+    some don't make it in time, none.
+
+    Parameters
+    ----------
+    client : Channel
+        client connection.
+    device : Device
+        the client's device.
+
+    Returns
+    -------
+    list
+        the streams to use.
+
+    """
+    count = utils.receive_file_size(client)
+    taken = device.take_streams(count, STREAM_WAIT)
+    if len(taken) < count:
+        for stream in taken:
+            stream.close()
+        taken = []
+    for stream in taken:
+        stream.codec = client.codec
+        stream.share = client.share
+    utils.send_size(client, len(taken))
+    return taken
+
+
+def tree(user):
+    # returns merkle tree of user's folder, built when first needed.
+    with user.lock:
+        if not user.tree:
+            user.tree = merkle.Tree(user.get_folder())
+        return user.tree
+
+
+def queue_depths():
+    # returns the updates queued for each device, by user folder and device.
+    with users_lock:
+        listed = list(users.values())
+    return {(os.path.basename(user.get_folder()), device.get_num()):
+            device.queued()
+            for user in listed for device in user.get_devices()}
+
+
+def track(key, device):
+    # journals a new device and every change to its updates.
+    journal.record(DEVICE, key, device.get_num(), device.cursor)
+    journal.track(key, device)
 
 
 if __name__ == "__main__":
-    main(int(sys.argv[1]))
+    parser = argparse.ArgumentParser(description="runs the drive server.")
+    parser.add_argument("port", type=int)
+    parser.add_argument("metrics_port", type=int, nargs="?", default=0,
+                        help="local port metrics are exposed on, 0 for none")
+    parser.add_argument("profile", type=float, nargs="?", default=0,
+                        help="share of sessions profiled")
+    parser.add_argument("processes", type=int, nargs="?", default=1,
+                        help="worker processes users are sharded over")
+    parser.add_argument("--cluster", metavar="FILE",
+                        help="file listing the cluster's nodes, one "
+                        "host:port a line")
+    parser.add_argument("--limit", type=float, metavar="MBPS",
+                        help="caps the server's bandwidth at this many MB a "
+                        "second, shared evenly by the users transferring")
+    parser.add_argument("--secret",
+                        help="shared by the cluster's nodes, needed to move "
+                        "users in")
+    parser.add_argument("--address",
+                        help="this node's host:port as listed in the "
+                        "cluster's file, 127.0.0.1:PORT by default")
+    args = parser.parse_args()
+    main(args.port, metrics_port=args.metrics_port or None,
+         profile=args.profile, processes=args.processes,
+         members=args.cluster, address=args.address,
+         rate=args.limit * 1e6 if args.limit else None, secret=args.secret)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Yotam Ben Dov 316387950
+@author: Nili Alfia 314880873
+"""
+
+import os
+import hashlib
+import threading
+
+# sizes
+STORE_BLOCK = 1048576  # files are deduplicated in blocks of this size.
+HASH_SIZE = 32  # size of a block's sha256 hash.
+
+# miscellaneous
+RECIPE = ".blocks"  # suffix of an object's list of block hashes.
+
+
+def block_hash(data):
+    # returns a block's content hash.
+    return hashlib.sha256(data).digest()
+
+
+class Store:
+    """
+    content addressed store behind the user folders. every received file is
+    kept once as an object, named after the hashes of its blocks, and
+    hardlinked into each user folder holding it. the blocks of all objects
+    are indexed so an upload only needs the blocks the store lacks.
+    """
+
+    def __init__(self, folder):
+        """
+        Parameters
+        ----------
+        folder : str
+            folder holding the objects, created if missing.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.folder = folder
+        self.index = {}  # block hash -> (object path, offset, length).
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.collect()
+        # indexes blocks of all remaining objects from their recipes.
+        with os.scandir(folder) as fdir:
+            for file in fdir:
+                if file.name.endswith(RECIPE):
+                    obj = file.path[: -len(RECIPE)]
+                    with open(file.path) as recipe:
+                        hashes = [bytes.fromhex(h)
+                                  for h in recipe.read().split()]
+                    self.add_blocks(obj, hashes)
+
+    # getters.
+    def get_folder(self):
+        # returns copy of folder path.
+        return self.folder
+
+    def has_block(self, digest):
+        # checks if a block is already stored.
+        with self.lock:
+            return digest in self.index
+
+    def read_block(self, digest):
+        # reads a stored block.
+        with self.lock:
+            obj, offset, length = self.index[digest]
+        with open(obj, "rb") as file:
+            file.seek(offset)
+            return file.read(length)
+
+    # setters.
+    def add_blocks(self, obj, hashes):
+        # indexes the blocks of an object.
+        size = os.path.getsize(obj)
+        for i, digest in enumerate(hashes):
+            offset = i * STORE_BLOCK
+            self.index.setdefault(
+                digest, (obj, offset, min(STORE_BLOCK, size - offset))
+            )
+
+    def link(self, temp, path, hashes):
+        """
+        stores a fully received file and links it into place.
+
+        Parameters
+        ----------
+        temp : str
+            the received file, consumed by the call.
+        path : str
+            destination in a user folder.
+        hashes : list
+            hashes of the file's blocks.
+
+        Returns
+        -------
+        None.
+
+        """
+        name = hashlib.sha256(b"".join(hashes)).hexdigest()
+        obj = os.path.join(self.folder, name)
+        with self.lock:
+            # identical content is already stored, keeps a single copy.
+            if os.path.exists(obj):
+                os.remove(temp)
+            else:
+                os.replace(temp, obj)
+                with open(obj + RECIPE, "w") as recipe:
+                    recipe.write("\n".join(h.hex() for h in hashes))
+                self.add_blocks(obj, hashes)
+            # path may already be a link to the object, rename would then
+            # leave temp behind.
+            if os.path.exists(path) and os.path.samefile(obj, path):
+                return
+            # links the object into place through temp, atomically.
+            os.link(obj, temp)
+            os.replace(temp, path)
+
+    def collect(self):
+        # removes objects no user folder links to anymore.
+        with os.scandir(self.folder) as fdir:
+            for file in fdir:
+                if file.name.endswith(RECIPE):
+                    continue
+                if file.stat().st_nlink == 1:
+                    os.remove(file.path)
+                    if os.path.exists(file.path + RECIPE):
+                        os.remove(file.path + RECIPE)
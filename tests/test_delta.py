@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Yotam Ben Dov 316387950
+@author: Nili Alfia 314880873
+"""
+
+import io
+import os
+import sys
+import random
+import socket
+import shutil
+import tempfile
+import threading
+import unittest
+
+# the modules sit at the repository's root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import utils  # noqa: E402
+import wire  # noqa: E402
+
+# sizes
+F_SIZE = 4194304  # the file's size, before it's edited.
+
+# miscellaneous
+SEED = 2
+
+
+class DeltaTest(unittest.TestCase):
+    """
+    a file sent as a delta against the receiver's older copy is rebuilt as
+    it is, and only what the edits changed is sent whole.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.old = os.path.join(self.root, "old")
+        self.new = os.path.join(self.root, "new")
+        self.data = random.Random(SEED).randbytes(F_SIZE)
+        with open(self.old, "wb") as file:
+            file.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def sent(self, data):
+        # sends data as a delta against the old file, returns how many of
+        # its bytes were sent whole.
+        with open(self.new, "wb") as file:
+            file.write(data)
+        ours, theirs = socket.socketpair()
+        ours, theirs = wire.Channel(ours), wire.Channel(theirs)
+        # the receiver's signatures, as the sender gets them.
+        utils.send_signatures(ours, self.old)
+        ours.flush()
+        weaks, strongs = utils.receive_signatures(theirs)
+
+        def send():
+            utils.send_delta(ours, self.new)
+            ours.flush()
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        try:
+            self.assertEqual(utils.receive_token(theirs), utils.DELTA)
+            utils.receive_delta(theirs, self.old)
+        finally:
+            sender.join()
+            ours.close()
+            theirs.close()
+        with open(self.old, "rb") as file:
+            self.assertEqual(file.read(), data)
+        return sum(len(value) for action, value in utils.delta(
+            io.BytesIO(data), weaks, strongs) if action == utils.DATA)
+
+    def test_insertion_at_start(self):
+        self.assertLessEqual(self.sent(b"x" + self.data), 1)
+
+    def test_edits(self):
+        # a byte inserted, a range deleted and one overwritten, apart.
+        data = bytearray(self.data)
+        data[3000000:3000010] = b"overwrite!"
+        del data[2000000:2000100]
+        data.insert(1000000, 0)
+        self.assertLessEqual(self.sent(bytes(data)), 4 * utils.BLOCK)
+
+    def test_new_content(self):
+        data = random.Random(SEED + 1).randbytes(F_SIZE // 2)
+        self.assertEqual(self.sent(data), len(data))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Yotam Ben Dov 316387950
+@author: Nili Alfia 314880873
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# the modules sit at the repository's root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import utils  # noqa: E402
+import journal  # noqa: E402
+from journal import Journal, USER, DEVICE  # noqa: E402
+
+# sizes
+SNAPSHOT_EVERY = 7  # small, so the tests go through several generations.
+
+
+class JournalTest(unittest.TestCase):
+    """
+    the state a journal recovers on reopening is the live state it recorded.
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.snapshot_every = journal.SNAPSHOT_EVERY
+        journal.SNAPSHOT_EVERY = SNAPSHOT_EVERY
+        self.journal = Journal(self.folder)
+        self.users = {}
+
+    def tearDown(self):
+        journal.SNAPSHOT_EVERY = self.snapshot_every
+        shutil.rmtree(self.folder)
+
+    def add_user(self, key, folder):
+        # registers a user with its first device, as the server does.
+        self.journal.record(USER, key, folder)
+        user = self.users[key] = utils.User(folder)
+        self.journal.track_user(key, user)
+        self.add_device(key, user.get_device())
+        return user
+
+    def add_device(self, key, device):
+        self.journal.record(DEVICE, key, device.get_num(), device.cursor)
+        self.journal.track(key, device)
+
+    def new_device(self, key):
+        user = self.users[key]
+        user.add_device(lambda device: self.add_device(key, device))
+        return user.devices[-1]
+
+    def recovered(self):
+        # reopens the journal's folder, returns the state of its users.
+        return state(Journal(self.folder).users())
+
+    def test_recovers_state(self):
+        user = self.add_user("k1", "user0")
+        other = self.new_device("k1")
+        for i in range(10):
+            user.update_devices(utils.CREATE, f"f{i}")
+        for path in ["a", "b", "c"]:
+            other.create(path)
+        other.modify("a")
+        other.delete("b")
+        # a round that went through, its pops go to the journal as one
+        # record.
+        while other.next_update():
+            pass
+        other.acknowledge()
+        other.create("left")
+        second = self.add_user("k2", "user1")
+        second.update_devices(utils.DELETE, "gone")
+        self.assertGreater(self.journal.generation, 1)
+        self.assertEqual(self.recovered(), state(self.users))
+        # recovers again from the snapshot the reopening took.
+        self.assertEqual(self.recovered(), state(self.users))
+
+    def test_line_cut_short(self):
+        user = self.add_user("k1", "user0")
+        user.get_device().create("kept")
+        # a crash while a record was being written leaves part of its line.
+        path = os.path.join(self.folder,
+                            journal.JOURNAL.format(self.journal.generation))
+        with open(path, "a") as file:
+            file.write('["queue", "k1", "0000", "app')
+        self.assertEqual(self.recovered(), state(self.users))
+
+    def test_unfinished_drain_is_sent_again(self):
+        # commands popped by a round that didn't finish are recovered.
+        user = self.add_user("k1", "user0")
+        device = user.get_device()
+        for path in ["a", "b", "c"]:
+            device.create(path)
+        device.next_update()
+        recovered = self.recovered()["k1"]["devices"]["0000"]["queue"]
+        self.assertEqual(recovered, [(utils.CREATE, path)
+                                     for path in ["a", "b", "c"]])
+
+
+def state(users):
+    # returns what the journal keeps of users, comparable.
+    return {
+        key: {
+            "folder": user.get_folder(),
+            "start": user.log.start,
+            "log": list(user.log.entries),
+            "devices": {
+                device.get_num(): {"cursor": device.saved_cursor,
+                                   "queue": list(device.updates)}
+                for device in user.get_devices()
+            },
+        }
+        for key, user in users.items()
+    }
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Yotam Ben Dov 316387950
+@author: Nili Alfia 314880873
+"""
+
+import os
+import sys
+import random
+import unittest
+
+# the modules sit at the repository's root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import utils  # noqa: E402
+from utils import CREATE, MODIFY, DELETE  # noqa: E402
+
+# sizes
+SEQUENCES = 20000  # random sequences of changes compared.
+LENGTH = 30  # changes in a sequence, at most.
+
+# miscellaneous
+PATHS = ["a", "b", "c", "d"]  # few paths, so changes pile up on them.
+SEED = 6
+
+
+class ListDevice:
+    """
+    the device's coalescing rules as they were on a plain list, before
+    UpdateQueue, as the reference the queue has to match.
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.last_action = {}
+
+    def delete(self, path):
+        if path in self.last_action.keys():
+            la_f = self.last_action[path]
+            if la_f == CREATE:
+                self.updates.remove((CREATE, path))
+                self.last_action.pop(path)
+            elif la_f == MODIFY:
+                self.updates.remove((MODIFY, path))
+                self.updates.append((DELETE, path))
+                self.last_action[path] = DELETE
+            elif isinstance(la_f, tuple):
+                self.updates.remove(la_f)
+                self.delete(la_f[0])
+                self.last_action.pop(path)
+        else:
+            self.updates.append((DELETE, path))
+            self.last_action[path] = DELETE
+
+    def modify(self, path):
+        if path in self.last_action.keys():
+            la_f = self.last_action[path]
+            if isinstance(la_f, tuple):
+                self.updates.remove(la_f)
+                self.updates.append((MODIFY, path))
+                self.last_action[path] = MODIFY
+                self.delete(la_f[0])
+            elif la_f == DELETE:
+                self.create(path)
+        else:
+            self.updates.append((MODIFY, path))
+            self.last_action[path] = MODIFY
+
+    def move(self, src, dest):
+        if src in self.last_action.keys():
+            la_src = self.last_action[src]
+            if isinstance(la_src, tuple):
+                self.updates.append((src, dest))
+                self.last_action[src] = (src, dest)
+                self.last_action[dest] = (src, dest)
+            else:
+                self.delete(src)
+                self.modify(dest)
+        else:
+            self.updates.append((src, dest))
+            self.last_action[src] = (src, dest)
+            self.last_action[dest] = (src, dest)
+
+    def create(self, path):
+        self.updates.append((CREATE, path))
+        self.last_action[path] = CREATE
+
+    def next_update(self):
+        if self.updates:
+            command = self.updates.pop(0)
+            if command[1] in self.last_action:
+                self.last_action.pop(command[1])
+            return command
+        self.last_action.clear()
+        return None
+
+
+class QueueTest(unittest.TestCase):
+    """
+    Device on an UpdateQueue coalesces changes exactly as on a list.
+    """
+
+    def test_matches_list(self):
+        rand = random.Random(SEED)
+        for sequence in range(SEQUENCES):
+            device, reference = utils.Device("0001"), ListDevice()
+            changes = []
+            for i in range(rand.randint(1, LENGTH)):
+                change = rand.choice(["create", "modify", "delete", "move",
+                                      "next_update"])
+                if change == "move":
+                    args = tuple(rand.sample(PATHS, 2))
+                elif change == "next_update":
+                    args = ()
+                else:
+                    args = (rand.choice(PATHS),)
+                changes.append((change, args))
+                # a change the list refused is refused by the queue too.
+                try:
+                    expected = getattr(reference, change)(*args)
+                except ValueError:
+                    with self.assertRaises(ValueError, msg=changes):
+                        getattr(device, change)(*args)
+                    break
+                self.assertEqual(getattr(device, change)(*args), expected,
+                                 changes)
+                self.assertEqual(list(device.updates), reference.updates,
+                                 changes)
+                self.assertEqual(device.last_action, reference.last_action,
+                                 changes)
+
+
+if __name__ == "__main__":
+    unittest.main()
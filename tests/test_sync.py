@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Yotam Ben Dov 316387950
+@author: Nili Alfia 314880873
+"""
+
+import os
+import sys
+import time
+import socket
+import shutil
+import tempfile
+import threading
+import unittest
+from watchdog.events import FileCreatedEvent, FileDeletedEvent, \
+    FileMovedEvent, DirMovedEvent
+
+# the modules sit at the repository's root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import utils  # noqa: E402
+import wire  # noqa: E402
+
+# miscellaneous
+DEBOUNCE = 0.05  # the handlers' debounce, short for the tests.
+WAIT = 5  # seconds a test waits for changes to be queued at most.
+
+
+class SyncTest(unittest.TestCase):
+    """
+    local changes on a sending folder, fed to its Handler as watchdog events,
+    are queued on its Device and sent over a socket pair to a receiving
+    folder that held the same files.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.sender = os.path.join(self.root, "sender")
+        self.receiver = os.path.join(self.root, "receiver")
+        os.makedirs(self.sender)
+        os.makedirs(self.receiver)
+        self.device = utils.Device("0001")
+        self.handler = utils.Handler(self.device, self.sender,
+                                     debounce=DEBOUNCE)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def both(self, path, data=None):
+        # creates a file, or a directory if no data, in both folders.
+        for base in (self.sender, self.receiver):
+            full_path = os.path.join(base, path)
+            if data is None:
+                os.makedirs(full_path, exist_ok=True)
+            else:
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                with open(full_path, "w") as file:
+                    file.write(data)
+
+    def local(self, path):
+        # returns a path in the sending folder.
+        return os.path.join(self.sender, path)
+
+    def queued(self, count):
+        # waits until the handler queued count updates on the device.
+        deadline = time.monotonic() + WAIT
+        while len(self.device.updates) < count:
+            self.assertLess(time.monotonic(), deadline, "nothing queued")
+            time.sleep(DEBOUNCE)
+        # lets the flusher finish the batch.
+        time.sleep(DEBOUNCE * 2)
+
+    def round(self):
+        # sends the device's updates and applies them on the receiving end.
+        ours, theirs = socket.socketpair()
+        ours, theirs = wire.Channel(ours), wire.Channel(theirs)
+        errors = []
+
+        def send():
+            try:
+                utils.send_updates(ours, self.device, base=self.sender)
+            except BaseException as error:
+                errors.append(error)
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        try:
+            utils.receive_updates(theirs, utils.Device("0000"),
+                                  base=self.receiver)
+        finally:
+            sender.join()
+            ours.close()
+            theirs.close()
+        if errors:
+            raise errors[0]
+
+    def test_move_then_delete_destination(self):
+        # renaming y to z and deleting z in one burst deletes y.
+        self.both("y.txt", "y")
+        os.rename(self.local("y.txt"), self.local("z.txt"))
+        self.handler.on_moved(FileMovedEvent(self.local("y.txt"),
+                                             self.local("z.txt")))
+        os.remove(self.local("z.txt"))
+        self.handler.on_deleted(FileDeletedEvent(self.local("z.txt")))
+        self.queued(1)
+        self.assertEqual(list(self.device.updates),
+                         [(utils.DELETE, "y.txt")])
+        self.round()
+        self.assertEqual(os.listdir(self.receiver), [])
+        # changes made afterwards are still queued and sent.
+        with open(self.local("after.txt"), "w") as file:
+            file.write("after")
+        self.handler.on_created(FileCreatedEvent(self.local("after.txt")))
+        self.queued(1)
+        self.round()
+        self.assertEqual(os.listdir(self.receiver), ["after.txt"])
+
+    def test_directory_move(self):
+        # a renamed directory is sent as one move, the moves watchdog adds
+        # for its contents aren't, and the round goes on after it.
+        self.both("d1/d2/f", "f")
+        self.both("d1/g", "g")
+        os.rename(self.local("d1"), self.local("d3"))
+        self.handler.on_moved(DirMovedEvent(self.local("d1"),
+                                            self.local("d3")))
+        for name, event in [("d2", DirMovedEvent), ("d2/f", FileMovedEvent),
+                            ("g", FileMovedEvent)]:
+            self.handler.on_moved(event(self.local("d1/" + name),
+                                        self.local("d3/" + name),
+                                        is_synthetic=True))
+        with open(self.local("after.txt"), "w") as file:
+            file.write("after")
+        self.handler.on_created(FileCreatedEvent(self.local("after.txt")))
+        self.queued(2)
+        self.assertEqual(list(self.device.updates),
+                         [("d1", "d3"), (utils.CREATE, "after.txt")])
+        self.round()
+        self.assertEqual(sorted(os.listdir(self.receiver)),
+                         ["after.txt", "d3"])
+        self.assertTrue(os.path.isfile(os.path.join(self.receiver,
+                                                    "d3/d2/f")))
+
+    def test_move_carried_by_directory(self):
+        # a content's move received after its directory's is already done.
+        self.both("d1/d2/f", "f")
+        os.rename(self.local("d1"), self.local("d3"))
+        with open(self.local("after.txt"), "w") as file:
+            file.write("after")
+        for command in [("d1", "d3"), ("d1/d2", "d3/d2"),
+                        (utils.CREATE, "after.txt")]:
+            self.device.updates.append(command)
+        self.round()
+        self.assertEqual(sorted(os.listdir(self.receiver)),
+                         ["after.txt", "d3"])
+        self.assertTrue(os.path.isfile(os.path.join(self.receiver,
+                                                    "d3/d2/f")))
+
+    def test_failed_receive_stops_expecting(self):
+        # a round cut short mid file leaves the path watched again.
+        ours, theirs = socket.socketpair()
+        ours, theirs = wire.Channel(ours), wire.Channel(theirs)
+        utils.send_token(ours, utils.CREATE)
+        utils.send_path(ours, "f")
+        utils.send_token(ours, utils.FILE)
+        utils.send_size(ours, 100)
+        ours.send(bytes(10))
+        ours.flush()
+        ours.close()
+        device = utils.Device("0001")
+        with self.assertRaises(ConnectionError):
+            utils.receive_updates(theirs, device, base=self.receiver)
+        theirs.close()
+        self.assertFalse(device.is_echo("f", None))
+
+    def test_failed_round_is_sent_again(self):
+        # a round that didn't go through sends all it took again, in order,
+        # the changes it read from the user's log included.
+        user = utils.User(self.sender)
+        device = user.get_device(user.add_device())
+        user.update_devices(utils.DELETE, "logged")
+        device.delete("x")
+        device.move("a", "b")
+        ours, theirs = socket.socketpair()
+        ours = wire.Channel(ours)
+        theirs.close()
+        with self.assertRaises(OSError):
+            utils.send_updates(ours, device, base=self.sender)
+        ours.close()
+        commands = []
+        while device.has_updates():
+            commands.append(device.next_update())
+        self.assertEqual(commands, [(utils.DELETE, "x"), ("a", "b"),
+                                    (utils.DELETE, "logged")])
+        self.assertEqual(len(user.log), 1)
+
+    def test_checkpoint_left_alone(self):
+        # a file received whole doesn't go through the checkpoint another
+        # transfer of the same path may resume from.
+        with open(self.local("f"), "w") as file:
+            file.write("new")
+        checkpoint = os.path.join(self.receiver, "f" + utils.PARTIAL)
+        with open(checkpoint, "w") as file:
+            file.write("kept")
+        self.device.updates.append((utils.CREATE, "f"))
+        self.round()
+        with open(os.path.join(self.receiver, "f")) as file:
+            self.assertEqual(file.read(), "new")
+        with open(checkpoint) as file:
+            self.assertEqual(file.read(), "kept")
+
+
+if __name__ == "__main__":
+    unittest.main()
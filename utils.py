@@ -6,7 +6,27 @@
 """
 
 import os
+import sys
+import socket
+import shutil
+import hashlib
+import threading
+import time
+import fnmatch
+import io
+import json
+import struct
+import queue
+import errno
+import itertools
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
 from watchdog.events import FileSystemEventHandler
+import compress
+import metrics
+import lazy
+from store import STORE_BLOCK, HASH_SIZE, block_hash
 
 # to avoid magic numbers etc.
 
@@ -19,9 +39,27 @@ NAME_SIZE = 10  # name shouldn't be longer than 10^10 either.
 FILE_SIZE = 16  # maximum file size at 10^16.
 ID_SIZE = 128  # default size of login key.
 CHUNK = 4096  # a moderate chunk of data.
+BLOCK = 65536  # delta transfer block, signatures are sent per block.
+DIGEST = 16  # size of a block's signature.
+DELTA_MIN = 1048576  # smaller modified files are simply sent whole.
+DELTA_SEARCH = 1048576  # offsets a delta looks for shifted blocks at, a file.
+INLINE = 65536  # files up to this size are sent whole instead of offered.
+SPLIT = 67108864  # new files from this size are spread over streams in parts.
+PART = 16777216  # size of such a part.
+BATCH_SIZE = 4194304  # small files are sent in batches of up to this size,
+BATCH_FILES = 1024  # and this many files and directories.
+MAX_CHUNK = 4194304  # longest chunk of compressed data accepted.
+WALKERS = 4  # threads listing directories while a tree is walked.
 
 # miscellaneous
 FORMAT = "UTF-8"  # encoding format used.
+PARTIAL = ".drvpart"  # suffix of files still being received.
+ECHO_TTL = 60  # seconds a received update's local echo is looked out for.
+PENDING = "pending"  # state of a path while a received update is applied.
+ADLER = 65521  # modulus of the rolling checksum, adler32's.
+DEBOUNCE = 0.3  # seconds without events before a burst is queued.
+MAX_DEBOUNCE = 2  # seconds a burst of events is held back at most.
+IGNORE = ["*.swp", "*.swx", "*~", ".~lock.*", "4913", ".git/"]  # never synced.
 LOGIN = "signin"
 REGISTER = "signup"
 DONE = "done"
@@ -30,6 +68,20 @@ FAIL = "fail"
 # file types
 FILE = "file"
 DIRECTORY = "fdir"
+DELTA = "dlta"  # file sent as changed blocks against receiver's copy.
+HASHED = "hash"  # file offered as block hashes, receiver asks for missing.
+STREAMED = "strm"  # file sent over one of the connection's streams.
+PIECE = "part"  # part of a file spread over the connection's streams.
+BATCH = "btch"  # small files and directories sent as one update.
+STUBBED = "stub"  # file left as a placeholder, see lazy.
+
+# encodings of a file's bytes
+RAW = "raw"
+PACKED = "pack"  # compressed with the connection's codec.
+
+# delta instructions
+DATA = "data"  # bytes the receiver doesn't have.
+COPY = "copy"  # a run of the receiver's own blocks.
 
 # actions
 CREATE = "create"
@@ -37,12 +89,45 @@ MOVE = "rename"
 DELETE = "delete"
 MODIFY = "modify"
 UPDONE = "updone"
+WAKE = "wakeup"  # asks the other side of a kept connection for a round.
+FETCH = "fetch"  # asks for the file of a placeholder.
+
+# net action of two actions on one path during a burst, None cancels both.
+NET = {
+    (CREATE, MODIFY): CREATE,
+    (CREATE, DELETE): None,
+    (MODIFY, CREATE): MODIFY,
+    (MODIFY, DELETE): DELETE,
+    (DELETE, CREATE): MODIFY,
+    (DELETE, MODIFY): MODIFY,
+}
+SEALED = "sealed"  # key tag of a pending action that must stay before a move.
+
+# wire headers, fields are sent big endian in frames of a wire.Channel.
+TOKEN = struct.Struct(">B")  # an action, file type or instruction.
+LENGTH = struct.Struct(">I")  # length of a path.
+SIZE = struct.Struct(">Q")  # a size, offset or count.
+WEAK = struct.Struct(">I")  # a block's rolling checksum, see delta.
+TOKENS = [CREATE, MOVE, DELETE, MODIFY, UPDONE, WAKE,
+          FILE, DIRECTORY, DELTA, HASHED, DATA, DONE, STREAMED, PIECE,
+          RAW, PACKED, BATCH, FETCH, STUBBED, COPY]
+CODES = {token: code for code, token in enumerate(TOKENS)}
+
+# change log
+LOG = "log"
+CURSOR = "cursor"
+TRIM = "trim"
+LOG_LIMIT = 100000  # logged changes kept for devices that are behind.
 
 
 class Handler(FileSystemEventHandler):
-    """ """
+    """
+    watchdog handler. events are held back until the folder is quiet for a
+    moment and reduced to one net change per path before they reach the
+    device, so a single save is queued (and sent) once.
+    """
 
-    def __init__(self, device, path):
+    def __init__(self, device, path, ignore=IGNORE, debounce=DEBOUNCE):
         """
         
 
@@ -52,6 +137,12 @@ class Handler(FileSystemEventHandler):
             DESCRIPTION.
         path : TYPE
             DESCRIPTION.
+        ignore : list, optional
+            fnmatch patterns of names never synced, a trailing "/" matches a
+            directory and everything in it. The default is IGNORE.
+        debounce : float, optional
+            seconds without events before they are queued. The default is
+            DEBOUNCE.
 
         Returns
         -------
@@ -61,6 +152,14 @@ class Handler(FileSystemEventHandler):
         FileSystemEventHandler()
         self.device = device
         self.path = path
+        self.ignore = ignore
+        self.debounce = debounce
+        # path, sealed path or numbered move -> net action, in arrival order.
+        self.pending = OrderedDict()
+        self.sealed = 0
+        self.first = self.last = 0
+        self.condition = threading.Condition()
+        threading.Thread(target=self.flusher, daemon=True).start()
 
     # miscellaneous methods.
     def get_path(self):
@@ -71,33 +170,183 @@ class Handler(FileSystemEventHandler):
         # returns device.
         return self.device
 
-    # overriding methods.
+    def is_ignored(self, path):
+        # checks if path matches one of the ignore patterns.
+        parts = path.split(os.sep)
+        for pattern in self.ignore:
+            if pattern.endswith("/"):
+                if any(fnmatch.fnmatch(p, pattern[:-1]) for p in parts):
+                    return True
+            elif fnmatch.fnmatch(parts[-1], pattern):
+                return True
+        return False
+
+    # debouncing.
+    def add(self, path, action):
+        # merges an event on a single path into its pending net action.
+        with self.condition:
+            # deleting where something was moved to deletes it where it was.
+            while action == DELETE:
+                moves = [key for key in self.pending if isinstance(key, tuple)
+                         and key[0] == MOVE and key[3] == path]
+                if not moves:
+                    break
+                self.pending.pop(path, None)
+                self.pending.pop(moves[-1])
+                path = moves[-1][2]
+            prev = self.pending.pop(path, None)
+            action = NET.get((prev, action), action)
+            if action:
+                self.pending[path] = action
+            self.touch()
+
+    def add_move(self, src, dest, is_dir):
+        # adds a move, pending actions on both paths stay before it.
+        with self.condition:
+            # a file created during the burst is simply created at dest.
+            if not is_dir and self.pending.get(src) == CREATE:
+                self.pending.pop(src)
+                prev = self.pending.pop(dest, None)
+                self.pending[dest] = NET.get((prev, CREATE), CREATE)
+            else:
+                for path in (src, dest):
+                    if path in self.pending:
+                        self.sealed += 1
+                        action = self.pending.pop(path)
+                        self.pending[(SEALED, self.sealed, path)] = action
+                self.sealed += 1
+                self.pending[(MOVE, self.sealed, src, dest)] = MOVE
+            self.touch()
+
+    def touch(self):
+        # notes event time and wakes the flusher.
+        now = time.monotonic()
+        if len(self.pending) and not self.first:
+            self.first = now
+        self.last = now
+        self.condition.notify()
+
+    def flusher(self):
+        # queues pending actions once events quiet down.
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                now = time.monotonic()
+                due = min(self.last + self.debounce,
+                          self.first + MAX_DEBOUNCE)
+                if now < due:
+                    self.condition.wait(due - now)
+                    continue
+                pending, self.pending = self.pending, OrderedDict()
+                self.first = 0
+            # a batch that fails to replay is lost, not the changes after it.
+            try:
+                self.flush(pending)
+            except Exception as error:
+                print(f"queuing local changes failed: {error!r}",
+                      file=sys.stderr)
+
+    def flush(self, pending):
+        # replays net actions into the device as one batch, modifications
+        # that left a file as it was last synced are dropped.
+        index = self.device.index
+        if index:
+            pending = OrderedDict(
+                (key, action) for key, action in pending.items()
+                if action != MODIFY or isinstance(key, tuple)
+                or index.changed(key))
+        with self.device.lock:
+            for key, action in pending.items():
+                if action == MOVE:
+                    self.device.move(key[2], key[3])
+                else:
+                    path = key[2] if isinstance(key, tuple) else key
+                    getattr(self.device, action)(path)
+
+    # overriding methods, files still being received are not local changes
+    # and neither are the echoes of updates just received.
     def on_created(self, event):
         # file is created event.
+        if is_unsynced(event.src_path):
+            return
         relative_path = os.path.relpath(event.src_path, self.path)
-        self.device.create(relative_path)
+        if self.is_ignored(relative_path):
+            return
+        if not self.device.is_echo(relative_path, file_state(event.src_path)):
+            self.add(relative_path, CREATE)
 
     def on_modified(self, event):
         # file is modified event.
-        if not event.is_directory:
+        if not event.is_directory and not is_unsynced(event.src_path):
             relative_path = os.path.relpath(event.src_path, self.path)
-            self.device.modify(relative_path)
+            if self.is_ignored(relative_path):
+                return
+            state = file_state(event.src_path)
+            if not self.device.is_echo(relative_path, state):
+                self.add(relative_path, MODIFY)
 
     def on_deleted(self, event):
         # file is deleted event.
-        relative_path = os.path.relpath(event.src_path, self.path)
-        self.device.delete(relative_path)
+        if is_partial(event.src_path):
+            return
+        src_path = event.src_path
+        # deleting a placeholder deletes its file, unless the file just
+        # replaced it.
+        if lazy.is_stub(src_path):
+            src_path = src_path[:-len(lazy.STUB)]
+            if os.path.lexists(src_path):
+                return
+        relative_path = os.path.relpath(src_path, self.path)
+        if self.is_ignored(relative_path):
+            return
+        if not self.device.is_echo(relative_path, file_state(src_path)):
+            self.add(relative_path, DELETE)
 
     def on_moved(self, event):
-        # file is moved event.
-        src = os.path.relpath(event.src_path, self.get_path())
-        dest = os.path.relpath(event.dest_path, self.get_path())
-        self.device.move(src, dest)
+        # file is moved event. the moves watchdog adds for the contents of a
+        # moved directory are part of the directory's.
+        if is_partial(event.src_path) or getattr(event, "is_synthetic", False):
+            return
+        src_path, dest_path = event.src_path, event.dest_path
+        # moving a placeholder moves its file, one renamed to a name that
+        # isn't a placeholder's is downloaded there.
+        fetch = False
+        if lazy.is_stub(src_path):
+            src_path = src_path[:-len(lazy.STUB)]
+            if lazy.is_stub(dest_path):
+                dest_path = dest_path[:-len(lazy.STUB)]
+            else:
+                fetch = True
+        elif lazy.is_stub(dest_path):
+            return
+        src = os.path.relpath(src_path, self.get_path())
+        dest = os.path.relpath(dest_path, self.get_path())
+        if self.device.is_echo((src, dest), file_state(dest_path)):
+            return
+        # moving from or to an ignored name is a change or a deletion.
+        if self.is_ignored(src):
+            if not self.is_ignored(dest):
+                self.add(dest, MODIFY)
+        elif self.is_ignored(dest):
+            self.add(src, DELETE)
+        else:
+            self.add_move(src, dest, event.is_directory)
+            if fetch:
+                self.add(dest, FETCH)
+
+    def on_closed_no_write(self, event):
+        # a placeholder opened for reading has its file downloaded, where
+        # the platform reports it (inotify).
+        if lazy.is_stub(event.src_path):
+            self.device.fetch(
+                os.path.relpath(event.src_path, self.path)[:-len(lazy.STUB)])
 
 
 class User:
     """
-    user class object.
+    user class object. changes received from any device go into one change
+    log, each device keeps a cursor of the last version it was sent.
     """
 
     def __init__(self, folder):
@@ -113,8 +362,18 @@ class User:
 
         """
         self.folder = folder
-        self.cur_device = Device("0000")
+        self.log = ChangeLog()
+        self.cur_device = self.own(Device("0000"))
         self.devices = [self.cur_device]
+        # guards the device list and log while several sessions run at once.
+        self.lock = threading.Lock()
+        # held by the session applying a device's updates to the folder, the
+        # files of two devices' rounds would mix.
+        self.applying = threading.Lock()
+        # called with each change to the log and cursors, if set.
+        self.journal = None
+        # merkle tree of the folder, kept by the server once needed.
+        self.tree = None
 
     # getters.
     def get_folder(self):
@@ -123,7 +382,8 @@ class User:
 
     def get_devices(self):
         # returns copy of device list.
-        return self.devices.copy()
+        with self.lock:
+            return self.devices.copy()
 
     def get_device(self, device_num=None):
         # returns current working device unless otherwise specified.
@@ -139,19 +399,242 @@ class User:
     def set_device(self, device_num):
         self.cur_device = self.devices[int(device_num)]
 
-    def add_device(self):
-        # creates a new device
-        new_device = Device(f"{len(self.devices)}".zfill(DEVICE_NUM))
-        self.devices.append(new_device)
+    def own(self, device, cursor=None):
+        # attaches a device, by default it's sent changes from now on.
+        device.owner = self
+        device.cursor = self.log.head() if cursor is None else cursor
+        device.saved_cursor = device.cursor
+        return device
+
+    def add_device(self, on_add=None):
+        # creates a new device, on_add sees it before any update reaches it.
+        with self.lock:
+            new_device = self.own(
+                Device(f"{len(self.devices)}".zfill(DEVICE_NUM)))
+            if on_add:
+                on_add(new_device)
+            self.devices.append(new_device)
         return new_device.get_num()
 
-    def update_devices(self, action, path, dest=None):
-        for i in range(len(self.devices)):
-            if i != int(self.cur_device.get_num()):
-                if dest:
-                    self.devices[i].updates.append((path, dest))
-                else:
-                    self.devices[i].updates.append((action, path))
+    def update_devices(self, action, path, dest=None, device=None):
+        # logs update for every device but the sender (current by default).
+        sender = device if device else self.cur_device
+        command = (path, dest) if dest else (action, path)
+        with self.lock:
+            self.log.append(sender.get_num(), command)
+            if self.journal:
+                self.journal(LOG, sender.get_num(), command)
+            # devices too far behind are bootstrapped again instead.
+            if len(self.log) > LOG_LIMIT:
+                self.trim(self.log.head() - LOG_LIMIT)
+            devices = self.devices.copy()
+        for other in devices:
+            if other is not sender:
+                other.notify()
+
+    # cursors.
+    def next_change(self, device):
+        # returns next logged command the device wasn't sent, else None.
+        with self.lock:
+            num = device.get_num()
+            device.cursor = max(device.cursor, self.log.start - 1)
+            while device.cursor < self.log.head():
+                device.cursor += 1
+                source, command = self.log.get(device.cursor)
+                if source != num:
+                    return command
+            return None
+
+    def acknowledge(self, device):
+        # saves the cursor of a device whose round went through and drops
+        # what every device got.
+        with self.lock:
+            if device.cursor != device.saved_cursor:
+                device.saved_cursor = device.cursor
+                if self.journal:
+                    self.journal(CURSOR, device.get_num(), device.cursor)
+            self.trim(min(d.saved_cursor for d in self.devices))
+
+    def rewind(self, device):
+        # moves a device's cursor back to where its last round that went
+        # through left it, what a failed round read is sent again.
+        with self.lock:
+            device.cursor = device.saved_cursor
+
+    def pending(self, device):
+        # checks if the log holds changes for the device.
+        with self.lock:
+            num = device.get_num()
+            device.cursor = max(device.cursor, self.log.start - 1)
+            while device.cursor < self.log.head():
+                if self.log.get(device.cursor + 1)[0] != num:
+                    return True
+                device.cursor += 1
+            return False
+
+    def lagging(self, device):
+        # checks if changes the device wasn't sent were already dropped.
+        with self.lock:
+            return device.cursor < self.log.start - 1
+
+    def resync(self, device):
+        # moves a lagging device's cursor to now, it's to be bootstrapped.
+        with self.lock:
+            device.cursor = device.saved_cursor = self.log.head()
+            if self.journal:
+                self.journal(CURSOR, device.get_num(), device.cursor)
+
+    def trim(self, version):
+        # drops logged changes up to version, caller holds the lock.
+        if version >= self.log.start:
+            self.log.trim(version)
+            if self.journal:
+                self.journal(TRIM, version)
+
+
+class ChangeLog:
+    """
+    sequenced log of changes, versions count up from 1. reading a version
+    takes constant time, old versions are dropped from the front.
+    """
+
+    def __init__(self, start=1):
+        """
+        Parameters
+        ----------
+        start : int, optional
+            version of the first entry. The default is 1.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.entries = []  # (source device num, command).
+        self.start = start
+
+    def __len__(self):
+        return len(self.entries)
+
+    def head(self):
+        # returns latest version, start - 1 if empty.
+        return self.start + len(self.entries) - 1
+
+    def get(self, version):
+        # returns entry at version.
+        return self.entries[version - self.start]
+
+    def append(self, source, command):
+        # logs a command from source device, returns its version.
+        self.entries.append((source, command))
+        return self.head()
+
+    def trim(self, version):
+        # drops entries up to and including version.
+        del self.entries[: version - self.start + 1]
+        self.start = version + 1
+
+
+class UpdateQueue:
+    """
+    queue of update commands in order of arrival. the same command may be
+    queued more than once, appending, removing (first occurrence, like
+    list.remove) and popping the oldest command all take constant time.
+    """
+
+    def __init__(self, listener=None):
+        """
+        Parameters
+        ----------
+        listener : function, optional
+            called whenever a command is queued. The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.commands = OrderedDict()  # sequence number -> command.
+        self.positions = {}  # command -> its sequence numbers, in order.
+        self.counter = 0
+        self.first = 0  # counts down for commands queued at the front.
+        self.listener = listener
+        # called with each change's method name and command, if set.
+        self.journal = None
+        # commands popped since the journal was last told, see commit.
+        self.drained = 0
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __iter__(self):
+        return iter(list(self.commands.values()))
+
+    def __contains__(self, command):
+        return command in self.positions
+
+    def append(self, command):
+        # queues command at the end.
+        self.counter += 1
+        self.commands[self.counter] = command
+        self.positions.setdefault(command, deque()).append(self.counter)
+        if self.journal:
+            self.commit()
+            self.journal("append", command)
+        if self.listener:
+            self.listener()
+
+    def appendleft(self, command):
+        # queues command at the front.
+        self.first -= 1
+        self.commands[self.first] = command
+        self.commands.move_to_end(self.first, last=False)
+        self.positions.setdefault(command, deque()).appendleft(self.first)
+        if self.journal:
+            self.commit()
+            self.journal("appendleft", command)
+        if self.listener:
+            self.listener()
+
+    def remove(self, command):
+        # removes first occurrence of command, ValueError if not queued.
+        if command not in self.positions:
+            raise ValueError(f"{command} not in queue")
+        del self.commands[self.pop_position(command)]
+        if self.journal:
+            self.commit()
+            self.journal("remove", command)
+
+    def discard(self, command):
+        # removes every occurrence of command, if any.
+        for seq in self.positions.pop(command, ()):
+            del self.commands[seq]
+        if self.journal:
+            self.commit()
+            self.journal("discard", command)
+
+    def popleft(self):
+        # removes and returns oldest command.
+        command = self.commands.popitem(last=False)[1]
+        self.pop_position(command)
+        if self.journal:
+            self.drained += 1
+        return command
+
+    def commit(self):
+        # journals the commands popped since last time as a single record,
+        # pops aren't journaled one by one.
+        if self.drained:
+            drained, self.drained = self.drained, 0
+            self.journal("drain", drained)
+
+    def pop_position(self, command):
+        # forgets and returns sequence number of command's first occurrence.
+        seqs = self.positions[command]
+        seq = seqs.popleft()
+        if not seqs:
+            del self.positions[command]
+        return seq
 
 
 class Device:
@@ -173,74 +656,420 @@ class Device:
 
         """
         self.dev_num = num
-        self.updates = []
+        self.updates = UpdateQueue(self.notify)
+        # on the server, the user whose change log the device reads.
+        self.owner = None
+        self.cursor = self.saved_cursor = 0
+        # commands the round in progress took from the queue, see requeue.
+        self.taken = []
         self.last_action = {}
+        # received path or move -> (expiry time, state it was left in).
+        self.echoes = OrderedDict()
+        # socket pair signalling queued updates to whoever waits on them.
+        self.waker = None
+        # on the server, streams opened for the device's next session.
+        self.streams = []
+        # on the server, the device's latest session, older ones end, and
+        # the lock its rounds hold so an older one's can't overlap them.
+        self.session = None
+        self.running = threading.Lock()
+        self.attached = threading.Condition(threading.Lock())
+        # on the client, index of the synced folder as last synced.
+        self.index = None
+        # on the server, what the device syncs down, a lazy.Rules if given.
+        self.rules = None
+        # updates are queued by the observer/other sessions while sending.
+        self.lock = threading.RLock()
 
     def get_num(self):
         return self.dev_num
 
     def delete(self, path):
-        if path in self.last_action.keys():
-            la_f = self.last_action[path]
-            if la_f == CREATE:
-                self.updates.remove((CREATE, path))
-                self.last_action.pop(path)
-            elif la_f == MODIFY:
-                self.updates.remove((MODIFY, path))
+        with self.lock:
+            if path in self.last_action.keys():
+                la_f = self.last_action[path]
+                if la_f == CREATE:
+                    self.updates.remove((CREATE, path))
+                    self.last_action.pop(path)
+                elif la_f == MODIFY:
+                    self.updates.remove((MODIFY, path))
+                    self.updates.append((DELETE, path))
+                    self.last_action[path] = DELETE
+                elif isinstance(la_f, tuple):
+                    self.updates.remove(la_f)
+                    self.delete(la_f[0])
+                    self.last_action.pop(path)
+            else:
                 self.updates.append((DELETE, path))
                 self.last_action[path] = DELETE
-            elif isinstance(la_f, tuple):
-                self.updates.remove(la_f)
-                self.delete(la_f[0])
-                self.last_action.pop(path)
-        else:
-            self.updates.append((DELETE, path))
-            self.last_action[path] = DELETE
 
     def modify(self, path):
-        if path in self.last_action.keys():
-            la_f = self.last_action[path]
-            if isinstance(la_f, tuple):
-                self.updates.remove(la_f)
+        with self.lock:
+            if path in self.last_action.keys():
+                la_f = self.last_action[path]
+                if isinstance(la_f, tuple):
+                    self.updates.remove(la_f)
+                    self.updates.append((MODIFY, path))
+                    self.last_action[path] = MODIFY
+                    self.delete(la_f[0])
+                elif la_f == DELETE:
+                    self.create(path)
+            else:
                 self.updates.append((MODIFY, path))
                 self.last_action[path] = MODIFY
-                self.delete(la_f[0])
-            elif la_f == DELETE:
-                self.create(path)
-        else:
-            self.updates.append((MODIFY, path))
-            self.last_action[path] = MODIFY
 
     def move(self, src, dest):
-        if src in self.last_action.keys():
-            la_src = self.last_action[src]
-            if isinstance(la_src, tuple):
+        with self.lock:
+            if src in self.last_action.keys():
+                la_src = self.last_action[src]
+                if isinstance(la_src, tuple):
+                    self.updates.append((src, dest))
+                    self.last_action[src] = (src, dest)
+                    self.last_action[dest] = (src, dest)
+                else:
+                    self.delete(src)
+                    self.modify(dest)
+            else:
                 self.updates.append((src, dest))
                 self.last_action[src] = (src, dest)
                 self.last_action[dest] = (src, dest)
-            else:
-                self.delete(src)
-                self.modify(dest)
-        else:
-            self.updates.append((src, dest))
-            self.last_action[src] = (src, dest)
-            self.last_action[dest] = (src, dest)
 
     def create(self, path):
-        self.updates.append((CREATE, path))
-        self.last_action[path] = CREATE
+        with self.lock:
+            self.updates.append((CREATE, path))
+            self.last_action[path] = CREATE
+
+    def fetch(self, path):
+        # asks for the file of a placeholder, once.
+        with self.lock:
+            if (FETCH, path) not in self.updates:
+                self.updates.append((FETCH, path))
 
     def clear_la(self):
-        self.last_action.clear()
+        with self.lock:
+            self.last_action.clear()
+
+    def expect(self, key):
+        # marks a path (or (src, dest) move) as being changed by a received
+        # update, events on it are echoes until it settles.
+        with self.lock:
+            self.echoes.pop(key, None)
+            self.echoes[key] = (time.monotonic() + ECHO_TTL, PENDING)
+
+    def abandon(self):
+        # forgets the received updates that were expected and never applied,
+        # a failed round's, so local events on their paths count again.
+        with self.lock:
+            for key in [key for key, (expiry, state) in self.echoes.items()
+                        if state == PENDING]:
+                del self.echoes[key]
+
+    def settle(self, key, state):
+        # records the state a received update left a path in.
+        with self.lock:
+            self.echoes.pop(key, None)
+            self.echoes[key] = (time.monotonic() + ECHO_TTL, state)
+
+    def is_echo(self, key, state):
+        # checks if an event is the local echo of a received update, that is
+        # if the path is still in the state the update left it in.
+        with self.lock:
+            # entries expire in insertion order, drops the expired ones.
+            now = time.monotonic()
+            while self.echoes and next(iter(self.echoes.values()))[0] <= now:
+                self.echoes.popitem(last=False)
+            if key in self.echoes:
+                expected = self.echoes[key][1]
+                return expected == PENDING or expected == state
+            # contents of a deleted directory are deleted along with it.
+            if state is None and isinstance(key, str):
+                parent = os.path.dirname(key)
+                while parent:
+                    if parent in self.echoes:
+                        return self.echoes[parent][1] in [PENDING, None]
+                    parent = os.path.dirname(parent)
+            return False
+
+    def wake_socket(self):
+        # returns a socket that becomes readable when updates are queued.
+        with self.lock:
+            if not self.waker:
+                self.waker = socket.socketpair()
+                for sock in self.waker:
+                    sock.setblocking(False)
+            return self.waker[0]
+
+    def notify(self):
+        # wakes up whoever waits on wake_socket, if anyone.
+        if self.waker:
+            try:
+                self.waker[1].send(b"\0")
+            except BlockingIOError:
+                pass
+
+    def clear_wake(self):
+        # consumes pending wake ups.
+        try:
+            while self.waker[0].recv(CHUNK):
+                pass
+        except BlockingIOError:
+            pass
+
+    def attach(self, stream):
+        # hands a stream to the session of the device that opened it.
+        with self.attached:
+            self.streams.append(stream)
+            self.attached.notify_all()
+
+    def take_streams(self, count, timeout):
+        # waits up to timeout for count streams, returns the newest count
+        # that arrived and closes any left from earlier connections.
+        with self.attached:
+            self.attached.wait_for(lambda: len(self.streams) >= count,
+                                   timeout)
+            streams, self.streams = self.streams, []
+        keep = len(streams) - min(count, len(streams))
+        for stream in streams[:keep]:
+            stream.close()
+        return streams[keep:]
+
+    def acknowledge(self):
+        # the round went through, forgets what it took and tells the journal.
+        with self.lock:
+            self.taken = []
+            self.updates.commit()
+            if self.owner:
+                self.owner.acknowledge(self)
+
+    def requeue(self, base):
+        # puts back what a failed round took from the queue in front of it,
+        # in order, and rewinds to the owner's log as last acknowledged. the
+        # other side resumes files it kept part of. files gone since aren't
+        # sent, nor ones changed since, they're queued already.
+        with self.lock:
+            for command in reversed(self.taken):
+                if command[0] in [CREATE, MODIFY] and (
+                        command[1] in self.last_action or not os.path.lexists(
+                            os.path.join(base, command[1]))):
+                    continue
+                self.updates.appendleft(command)
+            self.taken = []
+            if self.owner:
+                self.owner.rewind(self)
+
+    def queued(self):
+        # returns how many updates wait to be sent, own logged changes
+        # included.
+        depth = len(self.updates)
+        if self.owner is not None:
+            with self.owner.lock:
+                depth += max(0, self.owner.log.head() - self.cursor)
+        return depth
+
+    def has_updates(self):
+        # checks if there's anything to send.
+        if len(self.updates):
+            return True
+        return self.owner is not None and self.owner.pending(self)
+
+    def next_update(self):
+        # pops oldest update, then reads owner's log, clears last actions
+        # once both are drained.
+        with self.lock:
+            if self.updates:
+                command = self.updates.popleft()
+                self.taken.append(command)
+                if command[1] in self.last_action:
+                    self.last_action.pop(command[1])
+                return command
+            if self.owner:
+                command = self.owner.next_change(self)
+                if command:
+                    return command
+            self.last_action.clear()
+            return None
+
+
+class Scheduler:
+    """
+    spreads the file payloads of a round over a connection's streams. each
+    stream takes the next payload as soon as it's done with the last, and
+    new files of SPLIT bytes or more are spread over them in parts. payloads
+    are taken by how much of their file was queued before them, so whole
+    files go before the rest of the parts of larger ones and the parts of
+    several large files are interleaved. the other side applies every other
+    update only once the payloads announced before it have arrived, so
+    directories still come before their contents and moves and deletes
+    after the files they're about.
+    """
+
+    def __init__(self, streams, base, dedup):
+        """
+        Parameters
+        ----------
+        streams : list
+            the connection's streams, Channels.
+        base : str
+            folder the update paths are relative to.
+        dedup : bool
+            whether files are offered as block hashes first.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.base = base
+        self.dedup = dedup
+        # (bytes of the file before the payload, order queued, payload).
+        self.jobs = queue.PriorityQueue()
+        self.order = itertools.count()
+        self.errors = []
+        self.workers = [threading.Thread(target=self.work, args=(stream,),
+                                         daemon=True) for stream in streams]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, action, path):
+        # queues a file's payload, in parts if it's a large new file.
+        full_path = os.path.join(self.base, path)
+        f_size = os.path.getsize(full_path)
+        if action == CREATE and f_size >= SPLIT:
+            for offset in range(0, f_size, PART):
+                self.put(offset, (PIECE, path, f_size, offset))
+        else:
+            self.put(0, (action, path))
+
+    def put(self, rank, job):
+        self.jobs.put((rank, next(self.order), job))
+
+    def close(self):
+        # waits for every payload to be sent, raises the first failure.
+        for worker in self.workers:
+            self.put(float("inf"), None)
+        for worker in self.workers:
+            worker.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def work(self, stream):
+        # sends payloads over a stream until the round's are all taken.
+        try:
+            job = self.jobs.get()[2]
+            while job:
+                send_token(stream, job[0])
+                if job[0] == PIECE:
+                    send_piece(stream, *job[1:], self.base)
+                else:
+                    send(stream, job[1], self.base, job[0] == MODIFY,
+                         self.dedup)
+                job = self.jobs.get()[2]
+            send_token(stream, UPDONE)
+            stream.flush()
+        except Exception as error:
+            self.errors.append(error)
+
 
-    def ignore(self, lst):
-        # removes redundant commands.
-        temp = self.updates
-        self.updates = [x for x in temp + lst if x not in lst]
-        lst = [x for x in lst if x not in temp]
+class Collector:
+    """
+    receives the payloads a Scheduler spread over a connection's streams,
+    a thread per stream, and applies them as they arrive.
+    """
 
+    def __init__(self, streams, device, user, base, store):
+        """
+        Parameters
+        ----------
+        streams : list
+            the connection's streams, Channels.
+        device : Device
+            the device the updates are coming from.
+        user : User or None
+            if it's the server, the device's user.
+        base : str
+            folder the received paths are relative to.
+        store : Store or None
+            block store files are kept in, if any.
 
-def send_updates(client, device, redundant=[]):
+        Returns
+        -------
+        None.
+
+        """
+        self.device, self.user = device, user
+        self.base, self.store = base, store
+        self.inflight = {}  # path -> its payloads announced, not arrived.
+        self.errors = []
+        self.parts = {}  # path -> [bytes not arrived yet, resumed].
+        self.lock = threading.Condition()
+        self.readers = [threading.Thread(target=self.read, args=(stream,),
+                                         daemon=True) for stream in streams]
+        for reader in self.readers:
+            reader.start()
+
+    def expect(self, path):
+        # counts a payload announced on the connection.
+        with self.lock:
+            self.inflight[path] = self.inflight.get(path, 0) + 1
+            self.lock.notify_all()
+
+    def wait(self, path=None):
+        # waits until the announced payloads, of path only if given, arrive.
+        with self.lock:
+            self.lock.wait_for(lambda: self.errors or (
+                path not in self.inflight if path else not self.inflight))
+            if self.errors:
+                raise self.errors[0]
+
+    def close(self):
+        # waits for the streams to finish the round.
+        for reader in self.readers:
+            reader.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def fail(self, error):
+        # stops readers waiting on a round that failed.
+        with self.lock:
+            self.errors.append(error)
+            self.lock.notify_all()
+
+    def read(self, stream):
+        # applies payloads from a stream until its end of round.
+        try:
+            action = receive_token(stream)
+            while action != UPDONE:
+                path = receive_path(stream)
+                full_path = os.path.join(self.base, path)
+                # only once the updates before it are applied.
+                with self.lock:
+                    self.lock.wait_for(
+                        lambda: path in self.inflight or self.errors)
+                    if self.errors:
+                        return
+                if action == PIECE:
+                    action = CREATE
+                    done = receive_piece(stream, full_path, self.parts,
+                                         self.lock, self.store)
+                else:
+                    receive_body(stream, receive_token(stream), full_path,
+                                 self.store)
+                    done = True
+                if done:
+                    applied(self.device, self.user, action, path, path,
+                            full_path)
+                    with self.lock:
+                        self.inflight[path] -= 1
+                        if not self.inflight[path]:
+                            del self.inflight[path]
+                        self.lock.notify_all()
+                action = receive_token(stream)
+        except Exception as error:
+            self.fail(error)
+
+
+@metrics.PHASES.timed("send_updates")
+def send_updates(client, device, base="", dedup=False):
     """
     a function that takes a list of updates from a device and sends them, while
     also removing the last action of files sent.
@@ -251,54 +1080,251 @@ def send_updates(client, device, redundant=[]):
         a socket connected to a server/client.
     device : device object
         a device object hold the device's directory, updates and number.
+    base : str, optional
+        folder the update paths are relative to. The default is "" (cwd).
+    dedup : bool, optional
+        whether the receiver keeps a block store, files are then offered as
+        hashes first. The default is False.
+
+    Returns
+    -------
+    None.
+
+    """
+    # files too large to send inline go over the streams, if any.
+    scheduler = Scheduler(client.streams, base, dedup) if client.streams \
+        else None
+    # commands sent this round, the index takes them once it went through.
+    sent = []
+    try:
+        send_commands(client, device, base, dedup, scheduler, sent)
+        send_token(client, UPDONE)
+        # the other side may wait on the last frame before answering.
+        client.flush()
+        if scheduler:
+            scheduler.close()
+    except BaseException:
+        # what the round took is sent again next time.
+        device.requeue(base)
+        raise
+    device.acknowledge()
+    if device.index:
+        for command in sent:
+            if command[0] != FETCH:
+                device.index.synced(command)
+
+
+def send_commands(client, device, base, dedup, scheduler, sent):
+    # sends the device's updates, noting each in sent. files of over INLINE
+    # bytes are held back until the round's other updates are sent, smallest
+    # first, unless a move or delete touches them before.
+    # smaller ones and directories in a row are sent in batches.
+    held = {}  # path -> (command, size).
+    batch = {}  # path -> command.
+    batched = 0  # bytes in batch.
+    # check update and remove it from list, under the device's lock.
+    command = device.next_update()
+    while command:
+        sent.append(command)
+        command = narrowed(device, command, base)
+        if not command:
+            pass
+        elif command[0] == FETCH or command[0] == CREATE and stubbed(
+                device, command[1], base):
+            send_batch(client, list(batch.values()), base, dedup, scheduler)
+            batch, batched = {}, 0
+            send_command(client, command, base, dedup, scheduler,
+                         command[0] == CREATE)
+        elif command[0] in [CREATE, MODIFY]:
+            size = file_size(os.path.join(base, command[1]))
+            if size > INLINE:
+                held[command[1]] = (command, size)
+            else:
+                held.pop(command[1], None)
+                batch.setdefault(command[1], command)
+                batched += size
+                if len(batch) >= BATCH_FILES or batched >= BATCH_SIZE:
+                    send_batch(client, list(batch.values()), base, dedup,
+                               scheduler)
+                    batch, batched = {}, 0
+        else:
+            send_batch(client, list(batch.values()), base, dedup, scheduler)
+            batch, batched = {}, 0
+            # a held file moved or deleted is sent as it was queued, first.
+            paths = [command[1]] if command[0] == DELETE else list(command)
+            for path in [p for p in held if any(
+                    overlaps(p, other) for other in paths)]:
+                send_command(client, held.pop(path)[0], base, dedup,
+                             scheduler)
+            send_command(client, command, base, dedup, scheduler)
+        command = device.next_update()
+    send_batch(client, list(batch.values()), base, dedup, scheduler)
+    for command, size in sorted(held.values(), key=lambda item: item[1]):
+        send_command(client, command, base, dedup, scheduler)
+
+
+def send_batch(client, commands, base, dedup, scheduler):
+    """
+    sends creates and modifies of small files and directories as a single
+    update, the headers of all of them followed by the content of all the
+    files as one payload, compressed as a whole if that shrinks it. a
+    single command is sent on its own.
+
+    Parameters
+    ----------
+    client : socket
+        a socket connected to a server/client.
+    commands : list
+        the commands, in order.
+    base : str
+        folder the update paths are relative to.
+    dedup : bool
+        whether the receiver keeps a block store.
+    scheduler : Scheduler or None
+        the round's scheduler, for a single command.
 
     Returns
     -------
     None.
 
     """
-    # while there are still updates to send.
-    device.ignore(redundant)
-    while len(device.updates) > 0:
-        # check update and remove it from list.
-        command = device.updates.pop(0)
-        # if update is create/modify, notify action, upload and update device.
-        if command[0] in [CREATE, MODIFY]:
-            client.send(bytes(command[0], FORMAT))
-            send(client, command[1])
-        # else command is delete/move (local), notifies and updates device.
-        elif command[0] == DELETE:
-            if command[1] in device.last_action:
-                device.last_action.pop(command[1])
-            to_delete(client, command[1])
+    if len(commands) < 2:
+        for command in commands:
+            send_command(client, command, base, dedup, scheduler)
+        return
+    contents = []  # content of each file, None for a directory.
+    for command in commands:
+        full_path = os.path.join(base, command[1])
+        data = None
+        # what isn't a file is sent as a directory, as send does.
+        if os.path.isfile(full_path):
+            try:
+                with metrics.disk(), open(full_path, "rb") as file:
+                    data = file.read()
+            except OSError:
+                # deleted meanwhile, the delete comes after it.
+                data = b""
+        contents.append(data)
+    send_token(client, BATCH)
+    send_size(client, len(commands))
+    for command, data in zip(commands, contents):
+        send_token(client, command[0])
+        send_path(client, command[1])
+        if data is None:
+            send_token(client, DIRECTORY)
+        else:
+            send_token(client, FILE)
+            send_size(client, len(data))
+        metrics.OPERATIONS.add(1, "out", command[0])
+    blob = b"".join(data for data in contents if data)
+    stream_file(client, io.BytesIO(blob), len(blob), bool(
+        client.codec and len(blob) >= compress.MIN_SIZE and
+        compress.shrinks(client.codec, blob[:compress.SAMPLE])))
+
+
+def send_command(client, command, base, dedup, scheduler, stub=False):
+    # sends an update, a large file's payload over the streams if any, a
+    # created file only as a placeholder if stub.
+    if stub:
+        send_token(client, CREATE)
+        send_path(client, command[1])
+        send_token(client, STUBBED)
+    elif command[0] == FETCH:
+        send_token(client, FETCH)
+        send_path(client, command[1])
+    # if update is create/modify, notify action, upload and update device.
+    elif command[0] in [CREATE, MODIFY]:
+        send_token(client, command[0])
+        full_path = os.path.join(base, command[1])
+        if scheduler and os.path.isfile(full_path) \
+                and os.path.getsize(full_path) > INLINE:
+            send_path(client, command[1])
+            send_token(client, STREAMED)
+            scheduler.submit(command[0], command[1])
         else:
-            if command[1] in device.last_action:
-                device.last_action.pop(command[1])
-            to_move(client, command[0], command[1])
-    device.clear_la()
-    client.send(bytes(UPDONE, FORMAT))
+            send(client, command[1], base, command[0] == MODIFY, dedup)
+    # else command is delete/move (local), notifies and updates device.
+    elif command[0] == DELETE:
+        to_delete(client, command[1])
+    else:
+        to_move(client, command[0], command[1])
+    metrics.OPERATIONS.add(1, "out", command[0] if command[0] in [
+        CREATE, MODIFY, DELETE, FETCH] else MOVE)
+
+
+def narrowed(device, command, base):
+    # returns a command as it concerns a device with sync rules, None if it
+    # doesn't at all. moves out of what the device syncs are deletes, moves
+    # into it creates.
+    rules = device.rules
+    if not rules or command[0] == FETCH:
+        return command
+    if command[0] in [CREATE, MODIFY, DELETE]:
+        return None if rules.excludes(command[1]) else command
+    src, dest = command
+    if rules.excludes(dest):
+        return None if rules.excludes(src) else (DELETE, src)
+    if rules.excludes(src):
+        full_path = os.path.join(base, dest)
+        # a directory's contents are queued behind it.
+        if os.path.isdir(full_path):
+            upload_all(device, full_path, base)
+        return (CREATE, dest)
+    return command
+
+
+def stubbed(device, path, base):
+    # checks if a new file is sent to the device only as a placeholder.
+    return bool(device.rules) and \
+        device.rules.choice(path) == lazy.PLACEHOLDER and \
+        os.path.isfile(os.path.join(base, path))
+
+
+def file_size(path):
+    # returns a file's size, 0 for directories and what's gone.
+    try:
+        return 0 if os.path.isdir(path) else os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def overlaps(path, other):
+    # checks if either path is the other or inside it.
+    return path == other or path.startswith(other + os.sep) or \
+        other.startswith(path + os.sep)
 
 
 def to_delete(client, path):
     # send command to delete object at path.
-    client.send(bytes(DELETE, FORMAT))
+    send_token(client, DELETE)
     send_path(client, path)
 
 
 def to_move(client, src, dest):
     # send command to move object from src to dest
-    client.send(bytes(MOVE, FORMAT))
+    send_token(client, MOVE)
     send_path(client, src)
     send_path(client, dest)
 
 
+def send_token(client, token):
+    # sends an action, file type or instruction.
+    client.send(TOKEN.pack(CODES[token]))
+
+
 def send_path(client, path):
-    # sends path object.
-    path_len = f"{len(path):<{PATH_LEN}}"
-    client.send(bytes(path_len + path, FORMAT))
+    # sends path object, prefixed by its length in bytes.
+    data = path.encode(FORMAT)
+    client.send(LENGTH.pack(len(data)) + data)
+
 
+def send_size(client, size):
+    # sends a size, offset or count.
+    client.send(SIZE.pack(size))
 
-def send(client, path):
+
+@metrics.TRANSFERS.timed("out")
+def send(client, path, base="", delta=False, dedup=False):
     """
     navigates between directory sending and file sending.
     Parameters
@@ -307,6 +1333,14 @@ def send(client, path):
         DESCRIPTION.
     path : TYPE
         DESCRIPTION.
+    base : str, optional
+        folder path is relative to. The default is "" (cwd).
+    delta : bool, optional
+        whether a large file may be sent as a delta. The default is False.
+    dedup : bool, optional
+        whether the receiver keeps a block store, a modified file is then
+        offered as block hashes rather than sent as a delta. The default is
+        False.
 
     Returns
     -------
@@ -315,10 +1349,20 @@ def send(client, path):
     """
     # sends path and navigates to relevant helper func.
     send_path(client, path)
-    if os.path.isfile(path):
-        send_file(client, path)
+    full_path = os.path.join(base, path)
+    if os.path.isfile(full_path):
+        f_size = os.path.getsize(full_path)
+        # small files cost less to send than to offer.
+        if f_size <= INLINE:
+            send_file(client, full_path)
+        elif delta and not dedup and f_size >= DELTA_MIN:
+            send_delta(client, full_path)
+        # receiver skips blocks it has, in its store or kept from a transfer
+        # that was cut short.
+        else:
+            send_hashed(client, full_path)
     else:
-        client.send(bytes(DIRECTORY, FORMAT))
+        send_token(client, DIRECTORY)
 
 
 def send_file(client, path):
@@ -337,26 +1381,381 @@ def send_file(client, path):
     None.
 
     """
-    # sends size and then sends file itself.
+    # sends size and then streams file itself.
     f_size = os.path.getsize(path)
-    client.send(bytes(FILE + f"{f_size:<{FILE_SIZE}}", FORMAT))
-    file = open(path, "rb")
-    client.send(file.read())
+    send_token(client, FILE)
+    send_size(client, f_size)
+    with open(path, "rb") as file:
+        stream_file(client, file, f_size, compress.worth(client.codec, path))
+
+
+def stream_file(client, file, count, packed=False):
+    """
+    streams count bytes of an open file without loading it into memory.
+
+    Parameters
+    ----------
+    client : socket
+        client socket.
+    file : file object
+        file opened in binary mode, read from its current position.
+    count : int
+        number of bytes promised to the receiver.
+    packed : bool, optional
+        whether to compress them with the connection's codec. The default
+        is False.
+
+    Returns
+    -------
+    None.
+
+    """
+    if packed:
+        send_token(client, PACKED)
+        stream_packed(client, file, count)
+        return
+    send_token(client, RAW)
+    # zero-copy where the socket supports it, chunked sendall otherwise.
+    if hasattr(client, "sendfile"):
+        sent = client.sendfile(file, file.tell(), count) if count else 0
+    else:
+        sent = 0
+        while sent < count:
+            with metrics.disk():
+                data = file.read(min(BLOCK, count - sent))
+            if not data:
+                break
+            client.sendall(data)
+            sent += len(data)
+    # if file shrank meanwhile, pads so the stream stays aligned, the change
+    # itself will be reported again by the observer.
+    while sent < count:
+        padding = min(BLOCK, count - sent)
+        client.sendall(bytes(padding))
+        sent += padding
+
+
+def stream_packed(client, file, count):
+    # streams count bytes of a file compressed, in chunks prefixed by their
+    # length and followed by an empty one.
+    packer = compress.compressor(client.codec)
+    sent = 0
+    while sent < count:
+        # if file shrank meanwhile, pads as stream_file does.
+        with metrics.disk():
+            data = file.read(min(BLOCK, count - sent))
+        data = data or bytes(min(BLOCK, count - sent))
+        sent += len(data)
+        send_chunk(client, packer.compress(data))
+    send_chunk(client, packer.flush())
+    send_size(client, 0)
+
+
+def send_chunk(client, data):
+    # sends a chunk of compressed data, if the compressor gave any.
+    if data:
+        send_size(client, len(data))
+        client.sendall(data)
+
+
+def send_delta(client, path):
+    """
+    sends a file as the receiver's blocks it's made of, wherever they are in
+    it, and the bytes in between.
+
+    Parameters
+    ----------
+    client : socket
+        client socket.
+    path : str
+        file's path.
+
+    Returns
+    -------
+    None.
+
+    """
+    # sends size, then receives the signatures of the receiver's blocks.
+    f_size = os.path.getsize(path)
+    send_token(client, DELTA)
+    send_size(client, f_size)
+    weaks, strongs = receive_signatures(client)
+    # blocks in a row are sent as one run.
+    run = None  # [first block, count].
+    with open(path, "rb") as file:
+        for action, value in delta(file, weaks, strongs):
+            if action == COPY and run and run[0] + run[1] == value:
+                run[1] += 1
+                continue
+            if run:
+                send_token(client, COPY)
+                send_size(client, run[0])
+                send_size(client, run[1])
+                run = None
+            if action == COPY:
+                run = [value, 1]
+            else:
+                send_token(client, DATA)
+                send_size(client, len(value))
+                client.sendall(value)
+    if run:
+        send_token(client, COPY)
+        send_size(client, run[0])
+        send_size(client, run[1])
+    send_token(client, DONE)
+
+
+def delta(file, weaks, strongs):
+    """
+    goes over a file for the receiver's blocks, rsync's way. the block at
+    each offset is looked up by its signature, one that isn't there has the
+    offsets up to the next block tried by a rolling checksum, so blocks an
+    insertion or deletion shifted are still found. the search goes on only
+    for DELTA_SEARCH offsets a file, then blocks are looked up block by
+    block.
+
+    Parameters
+    ----------
+    file : file object
+        the file, opened in binary mode.
+    weaks : dict
+        rolling checksum of each of the receiver's blocks -> its index.
+    strongs : dict
+        signature of each of the receiver's blocks -> its index.
+
+    Yields
+    ------
+    tuple
+        (COPY, index of a receiver's block) or (DATA, bytes in between).
+
+    """
+    budget = DELTA_SEARCH
+    # the file is read ahead, a search looks a block past the one it's at.
+    buffer = b""
+    pos = 0  # where in buffer the next block starts.
+    literal = 0  # where in buffer the bytes not yet yielded start.
+    ended = False
+    while True:
+        if len(buffer) - pos < 2 * BLOCK and not ended:
+            if literal < pos:
+                yield DATA, buffer[literal:pos]
+            with metrics.disk():
+                read = file.read(4 * BLOCK)
+            ended = not read
+            buffer, pos, literal = buffer[pos:] + read, 0, 0
+            continue
+        window = buffer[pos:pos + BLOCK]
+        if not window:
+            break
+        index = strongs.get(signature(window))
+        if index is None and budget > 0 and len(window) == BLOCK:
+            found = roll(buffer, pos, weaks, strongs)
+            budget -= found[0] - pos if found else BLOCK
+            if found:
+                pos, index = found
+                window = buffer[pos:pos + BLOCK]
+        if index is None:
+            # bytes of no block, the search went over them already.
+            pos += len(window)
+            if pos - literal >= BLOCK:
+                yield DATA, buffer[literal:pos]
+                literal = pos
+            continue
+        if literal < pos:
+            yield DATA, buffer[literal:pos]
+        yield COPY, index
+        pos += len(window)
+        literal = pos
+    if literal < len(buffer):
+        yield DATA, buffer[literal:]
+
+
+def roll(buffer, pos, weaks, strongs):
+    # returns the first (offset, block index) after pos and up to a block
+    # past it a receiver's block is at, None if there's none. the checksum
+    # of the block at each offset is the last one's, rolled by a byte.
+    checksum = zlib.adler32(buffer[pos:pos + BLOCK])
+    low, high = checksum & 0xffff, checksum >> 16
+    for offset in range(pos + 1, min(pos + BLOCK, len(buffer) - BLOCK + 1)):
+        out, into = buffer[offset - 1], buffer[offset + BLOCK - 1]
+        low = (low - out + into) % ADLER
+        high = (high - BLOCK * out + low - 1) % ADLER
+        if high << 16 | low in weaks:
+            index = strongs.get(signature(buffer[offset:offset + BLOCK]))
+            if index is not None:
+                return offset, index
+    return None
+
+
+def send_hashed(client, path):
+    """
+    offers a file as the hashes of its blocks and sends only the blocks the
+    receiver lacks.
+
+    Parameters
+    ----------
+    client : socket
+        client socket.
+    path : str
+        file's path.
+
+    Returns
+    -------
+    None.
+
+    """
+    f_size = os.path.getsize(path)
+    with open(path, "rb") as file:
+        send_token(client, HASHED)
+        send_size(client, f_size)
+        send_blocks(client, file, f_size, 0, -(-f_size // STORE_BLOCK),
+                    compress.worth(client.codec, path))
+
+
+def send_blocks(client, file, f_size, first, count, packed=False):
+    """
+    offers blocks of a file as their hashes, then sends the ones the
+    receiver asks for.
+
+    Parameters
+    ----------
+    client : socket
+        client socket.
+    file : file object
+        the file, opened in binary mode.
+    f_size : int
+        file's size.
+    first : int
+        index of the first block offered.
+    count : int
+        number of blocks offered.
+    packed : bool, optional
+        whether to compress them with the connection's codec. The default
+        is False.
+
+    Returns
+    -------
+    None.
+
+    """
+    hashes = []
+    for i in range(first, first + count):
+        file.seek(i * STORE_BLOCK)
+        hashes.append(block_hash(file.read(block_size(f_size, i))))
+    # sends hashes, receives which blocks are missing.
+    send_size(client, count)
+    client.sendall(b"".join(hashes))
+    wanted = client.recv(count)
+    for i, flag in enumerate(wanted):
+        if flag == ord("1"):
+            file.seek((first + i) * STORE_BLOCK)
+            stream_file(client, file, block_size(f_size, first + i), packed)
+
+
+def block_size(f_size, index):
+    # returns the length of a file's store block at index.
+    return min(STORE_BLOCK, f_size - index * STORE_BLOCK)
+
+
+def signature(data):
+    # returns a block's signature.
+    return hashlib.blake2b(data, digest_size=DIGEST).digest()
+
+
+def send_signatures(client, path):
+    # sends the rolling checksum and signature of every block of file at
+    # path, if it exists.
+    weaks, strongs = [], []
+    if os.path.isfile(path):
+        with open(path, "rb") as file:
+            for data in iter(lambda: file.read(BLOCK), b""):
+                weaks.append(WEAK.pack(zlib.adler32(data)))
+                strongs.append(signature(data))
+    send_size(client, len(strongs))
+    client.sendall(b"".join(weaks) + b"".join(strongs))
+
+
+def receive_signatures(client):
+    # receives the receiver's blocks' rolling checksums and signatures, each
+    # -> the first block's index it's of.
+    count = receive_file_size(client)
+    data = client.recv(count * (WEAK.size + DIGEST))
+    weaks, strongs = {}, {}
+    for index in range(count):
+        weaks.setdefault(WEAK.unpack_from(data, index * WEAK.size)[0],
+                         index)
+        start = count * WEAK.size + index * DIGEST
+        strongs.setdefault(data[start:start + DIGEST], index)
+    return weaks, strongs
 
 
 def upload_all(device, path, base):
-    # for each file in path.
+    # for each file in path, directories before their contents.
+    for file, is_dir in walk(path):
+        # skips leftovers of interrupted transfers and placeholders.
+        if is_unsynced(file.name):
+            continue
+        # get relative path and add it to updates.
+        device.create(os.path.relpath(file.path, base))
+
+
+def walk(path, workers=WALKERS):
+    """
+    walks a directory tree without recursion, from a queue of directories
+    left to list. with several workers the directories are listed and their
+    entries stat-ed in a thread pool, which pays off on file systems where
+    every stat is a round trip, like NFS.
+
+    Parameters
+    ----------
+    path : str
+        the tree's root, not yielded itself.
+    workers : int, optional
+        threads listing directories, 1 lists them in the calling thread.
+        The default is WALKERS.
+
+    Yields
+    ------
+    os.DirEntry
+        every entry in the tree, a directory always before its contents.
+    bool
+        whether the entry is a directory, symbolic links are not followed.
+
+    """
+    if workers <= 1:
+        left = deque([path])
+        while left:
+            for entry, is_dir in list_dir(left.popleft()):
+                yield entry, is_dir
+                if is_dir:
+                    left.append(entry.path)
+        return
+    with ThreadPoolExecutor(workers) as pool:
+        left = deque([pool.submit(list_dir, path)])
+        while left:
+            for entry, is_dir in left.popleft().result():
+                yield entry, is_dir
+                if is_dir:
+                    left.append(pool.submit(list_dir, entry.path))
+
+
+def list_dir(path):
+    # lists a directory's entries, with their stat taken and cached.
+    entries = []
     with os.scandir(path) as fdir:
-        for file in fdir:
-            # get relative path and add it to updates.
-            r_path = os.path.relpath(file.path, base)
-            device.create(r_path)
-            # if file is a folder, activate recursively.
-            if file.is_dir():
-                upload_all(device, file.path, base)
+        for entry in fdir:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if not is_dir:
+                try:
+                    entry.stat()
+                except OSError:
+                    pass
+            entries.append((entry, is_dir))
+    return entries
 
 
-def receive_updates(client, device, user=None):
+@metrics.PHASES.timed("receive_updates")
+def receive_updates(client, device, user=None, base="", store=None):
     """
     receives updates from sender.
 
@@ -364,115 +1763,792 @@ def receive_updates(client, device, user=None):
     ----------
     client : socket
         client socket.
+    device : Device
+        the device the updates are coming from.
     user : User, optional
         if it's the server, updates devices. The default is None.
+    base : str, optional
+        folder the received paths are relative to. The default is "" (cwd).
+    store : Store, optional
+        block store files are kept in, if any. The default is None.
 
     Returns
     -------
-    list of duplicate commands to ignore.
+    None.
+
+    """
+    # payloads spread over the connection's streams are received meanwhile.
+    collector = Collector(client.streams, device, user, base, store) \
+        if client.streams else None
+    try:
+        # while there are still updates to send, gets update action and path.
+        while True:
+            action = receive_token(client)
+            # wake ups crossing a round already on its way carry no update.
+            if action == WAKE:
+                continue
+            # elif done uploading, breaks out of loop.
+            if action == UPDONE:
+                break
+            if action == BATCH:
+                receive_batch(client, device, user, base, store, collector)
+                continue
+            path = receive_path(client)
+            full_path = os.path.join(base, path)
+            # the device opened a placeholder, the file goes out next round.
+            if action == FETCH:
+                if os.path.isfile(full_path):
+                    device.modify(path)
+                continue
+            # expects local echoes of the update before applying it.
+            key = path
+            if action != MOVE:
+                device.expect(key)
+            # if update is create or modify, receives file to given path.
+            if action in [CREATE, MODIFY]:
+                f_type = receive_token(client)
+                if f_type == STUBBED:
+                    lazy.create_stub(full_path)
+                    device.settle(key, file_state(full_path))
+                    continue
+                if f_type == STREAMED:
+                    # applied by the collector once it arrives.
+                    collector.expect(path)
+                    continue
+                # a file still coming over a stream is replaced once it's in.
+                if collector:
+                    collector.wait(path)
+                receive_body(client, f_type, full_path, store)
+                applied(device, user, action, path, key, full_path)
+                continue
+            # moves and deletes may be about streamed files, waits for all.
+            if collector:
+                collector.wait()
+            # elif update is to delete, seperate cases for dirs and files.
+            if action == DELETE:
+                if os.path.isdir(full_path):
+                    delete_dir(full_path, full_path)
+                elif stub_only(full_path):
+                    os.remove(full_path + lazy.STUB)
+                else:
+                    # a file whose create was cut short may only have left
+                    # what the transfer kept of it, which goes either way.
+                    if os.path.lexists(full_path):
+                        os.remove(full_path)
+                    if os.path.exists(full_path + PARTIAL):
+                        os.remove(full_path + PARTIAL)
+            # else it's a move command, receives dest and moves file.
+            else:
+                action = path
+                src = full_path
+                path = receive_path(client)
+                full_path = os.path.join(base, path)
+                key = (action, path)
+                device.expect(key)
+                # a move already carried along by its directory's is done.
+                if not os.path.lexists(src) and os.path.lexists(full_path):
+                    pass
+                elif os.path.isdir(src):
+                    try:
+                        move_dir(src, full_path)
+                    except OSError:
+                        delete_dir(full_path, full_path)
+                        move_dir(src, full_path)
+                elif stub_only(src):
+                    os.replace(src + lazy.STUB, full_path + lazy.STUB)
+                else:
+                    os.replace(src, full_path)
+            applied(device, user, action, path, key, full_path)
+    except BaseException as error:
+        if collector:
+            collector.fail(error)
+        # paths whose updates never made it are watched again.
+        device.abandon()
+        raise
+    if collector:
+        try:
+            collector.close()
+        except BaseException:
+            device.abandon()
+            raise
+
+
+def receive_batch(client, device, user, base, store, collector):
+    """
+    receives and applies a batch sent by send_batch, in one pass: the
+    directories are created and the files written to temporary files, each
+    synced to disk, then moved into place.
+
+    Parameters
+    ----------
+    client : socket
+        client socket.
+    device : Device
+        the device the updates are coming from.
+    user : User or None
+        if it's the server, the device's user.
+    base : str
+        folder the received paths are relative to.
+    store : Store or None
+        block store files are kept in, if any.
+    collector : Collector or None
+        the round's collector, if payloads come over streams.
+
+    Returns
+    -------
+    None.
+
+    """
+    entries = []  # (action, path, size, None for a directory).
+    for i in range(receive_file_size(client)):
+        action = receive_token(client)
+        path = receive_path(client)
+        size = receive_file_size(client) \
+            if receive_token(client) == FILE else None
+        entries.append((action, path, size))
+    blob = io.BytesIO()
+    receive_into(client, blob, sum(size or 0 for a, p, size in entries))
+    blob.seek(0)
+    written = {}  # path -> its temporary file, not in place yet.
+    try:
+        for action, path, size in entries:
+            full_path = os.path.join(base, path)
+            device.expect(path)
+            if size is None:
+                receive_dir(full_path)
+                continue
+            # a file still coming over a stream is replaced once it's in.
+            if collector:
+                collector.wait(path)
+            # makes sure data is on disk before it becomes visible, syncing
+            # only the batch's files, not the whole machine's.
+            with metrics.disk(), open(scratch(full_path), "wb") as file:
+                written[path] = file.name
+                file.write(blob.read(size))
+                file.flush()
+                os.fsync(file.fileno())
+        blob.seek(0)
+        for action, path, size in entries:
+            full_path = os.path.join(base, path)
+            if size is not None:
+                data = blob.read(size)
+                if store is not None:
+                    store.link(written[path], full_path, [
+                        block_hash(data[i:i + STORE_BLOCK])
+                        for i in range(0, size, STORE_BLOCK)])
+                else:
+                    os.replace(written[path], full_path)
+            applied(device, user, action, path, path, full_path)
+    except BaseException:
+        # a dropped connection leaves no corrupt file behind.
+        for temp in written.values():
+            if os.path.exists(temp):
+                os.remove(temp)
+        raise
+
+
+@metrics.TRANSFERS.timed("out")
+def send_piece(client, path, f_size, offset, base=""):
+    # sends the part of a file spread over streams starting at offset.
+    send_path(client, path)
+    length = min(PART, f_size - offset)
+    send_size(client, f_size)
+    send_size(client, offset)
+    send_size(client, length)
+    full_path = os.path.join(base, path)
+    try:
+        file = open(full_path, "rb")
+    except FileNotFoundError:
+        # deleted meanwhile, sends zeros, the delete comes after it.
+        file = io.BytesIO()
+    with file:
+        send_blocks(client, file, f_size, offset // STORE_BLOCK,
+                    -(-length // STORE_BLOCK),
+                    compress.worth(client.codec, full_path))
+
+
+@metrics.TRANSFERS.timed("in")
+def receive_body(client, f_type, path, store=None):
+    # receives a created or modified file or directory by its type.
+    if f_type == DIRECTORY:
+        receive_dir(path)
+    elif f_type == DELTA:
+        receive_delta(client, path)
+    elif f_type == HASHED:
+        receive_hashed(client, path, store)
+    else:
+        receive_file(client, path, store)
+
+
+def applied(device, user, action, path, key, full_path):
+    # records a received update once it's applied.
+    # a downloaded file replaces its placeholder.
+    if action in [CREATE, MODIFY] and os.path.lexists(full_path + lazy.STUB):
+        os.remove(full_path + lazy.STUB)
+    device.settle(key, file_state(full_path))
+    if device.index:
+        device.index.synced((action, path))
+    # the user's merkle tree may be built mid round, checks every time.
+    if user and user.tree:
+        user.tree.invalidate(path)
+        if key != path:
+            user.tree.invalidate(action)
+    metrics.OPERATIONS.add(1, "in", MOVE if key != path else action)
+    if user:
+        user.update_devices(action, path, device=device)
+
+
+def reconcile(client, device, tree, base, rules=None):
+    """
+    brings a folder that may already hold most files in line with the
+    server's copy, comparing merkle trees from the root down and walking
+    only into directories whose hashes differ. files missing here or
+    different are downloaded, files only here are uploaded. with rules,
+    files missing here that are excluded are skipped and those not pinned
+    in lazy mode left as placeholders.
+
+    Parameters
+    ----------
+    client : socket
+        client socket.
+    device : Device
+        current device, files to upload are queued on it.
+    tree : Tree
+        merkle tree of base.
+    base : str
+        the synced folder.
+    rules : Rules, optional
+        what the device syncs down. The default is None, everything.
+
+    Returns
+    -------
+    None.
+
+    """
+    downloads = []
+    expand = [""]
+    while expand:
+        # asks for the listings of all differing directories at once.
+        send_json(client, expand)
+        theirs = receive_json(client)
+        deeper = []
+        for path in expand:
+            # directories created here as placeholders weren't listed.
+            ours = tree.listing(path) or {"hash": None, "children": {}}
+            if theirs[path]["hash"] == ours["hash"]:
+                continue
+            remote, local = theirs[path]["children"], ours["children"]
+            for name in set(remote) | set(local):
+                child = os.path.join(path, name)
+                if remote.get(name) == local.get(name):
+                    continue
+                if name not in remote:
+                    # only here, uploads it.
+                    device.create(child)
+                    if local[name][0] == DIRECTORY:
+                        upload_all(device, os.path.join(base, child), base)
+                elif name not in local:
+                    choice = rules.choice(child) if rules else lazy.DOWNLOAD
+                    if choice == lazy.DOWNLOAD:
+                        downloads.append([child, False])
+                    elif choice == lazy.PLACEHOLDER:
+                        # a directory is walked into, files left as stubs.
+                        if remote[name][0] == DIRECTORY:
+                            os.makedirs(os.path.join(base, child),
+                                        exist_ok=True)
+                            deeper.append(child)
+                        else:
+                            lazy.create_stub(os.path.join(base, child))
+                elif remote[name][0] != local[name][0]:
+                    # a file replaced by a directory or the other way round.
+                    full_path = os.path.join(base, child)
+                    if os.path.isdir(full_path):
+                        delete_dir(full_path, full_path)
+                    else:
+                        os.remove(full_path)
+                    downloads.append([child, False])
+                elif remote[name][0] == DIRECTORY:
+                    deeper.append(child)
+                else:
+                    # both have it, the server's copy wins.
+                    downloads.append([child, True])
+        expand = deeper
+    send_json(client, [])
+    send_json(client, downloads)
+
+
+def serve_reconcile(client, device, tree, base):
+    """
+    server side of reconcile, answers listings and then queues the files
+    the device asked for.
+
+    Parameters
+    ----------
+    client : socket
+        client socket.
+    device : Device
+        the reconciling device.
+    tree : Tree
+        merkle tree of base.
+    base : str
+        the user's folder.
+
+    Returns
+    -------
+    None.
 
     """
-    redundant_updates = []
-    # while there are still updates to send, gets update action and path.
     while True:
-        action = client.recv(ACTION).decode()
-        # elif done uploading, breaks out of loop.
-        if action == UPDONE:
+        paths = receive_json(client)
+        if not paths:
             break
-        path = receive_path(client)
-        # if update is create or modify, receives file to given path.
-        if action in [CREATE, MODIFY]:
-            f_type = client.recv(TYPE).decode()
-            if f_type == DIRECTORY:
-                receive_dir(path)
-            else:
-                receive_file(client, path)
-        # elif update is to delete, seperate cases for directories and files.
-        elif action == DELETE:
-            if os.path.isdir(path):
-                delete_dir(path, path)
-            else:
-                os.remove(path)
-        # else it's a move command, receives dest and moves file.
+        send_json(client, {path: tree.listing(path) for path in paths})
+    for path, exists in receive_json(client):
+        if not is_contained(path):
+            raise ConnectionError(f"path {path!r} leads out of the folder")
+        full_path = os.path.join(base, path)
+        # files it holds another version of can be sent as deltas.
+        if exists and os.path.isfile(full_path):
+            device.modify(path)
         else:
-            action = path
-            path = receive_path(client)
-            if os.path.isdir(action):
-                try:
-                    move_dir(action, path)
-                except OSError:
-                    delete_dir(path, path)
-                    move_dir(action, path)
-            else:
-                os.replace(action, path)
-        redundant_updates.append((action, path))
-        if user:
-            user.update_devices(action, path)
-    return redundant_updates
+            device.create(path)
+            if os.path.isdir(full_path):
+                upload_all(device, full_path, base)
+
+
+def send_json(client, obj):
+    # sends a json object, prefixed by its length.
+    data = json.dumps(obj).encode(FORMAT)
+    send_size(client, len(data))
+    client.sendall(data)
+
+
+def receive_json(client):
+    # receives a json object sent by send_json.
+    return json.loads(client.recv(receive_file_size(client)))
 
 
 def move_dir(src, dest):
     """
-    moves src directory with files to dest.
+    moves src directory with files to dest, in a single rename unless they
+    are on different file systems. fails if dest is a non empty directory.
     """
-    # tries to create destination folder
     try:
-        os.mkdir(dest)
-    # regardless, scans subfiles and folders and sends recursively.
-    finally:
-        with os.scandir(src) as fdir:
-            for file in fdir:
-                new = os.path.join(dest, file.name)
-                # enters recursion if file is dir.
-                if file.is_dir:
-                    os.mkdir(new)
-                    move_dir(file.path, new)
-                # else moves file.
-                else:
-                    os.replace(file.path, new)
-    # deletes original directory at the end.
-    os.rmdir(src)
+        os.replace(src, dest)
+        return
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+    # moves entry by entry, directories before their contents.
+    os.mkdir(dest)
+    for file, is_dir in walk(src):
+        new = os.path.join(dest, os.path.relpath(file.path, src))
+        if is_dir:
+            os.mkdir(new)
+        else:
+            shutil.move(file.path, new)
+    delete_dir(src, src)
 
 
 def delete_dir(cur_dir, base):
-    # removes directories with files recursively.
-    with os.scandir(cur_dir) as fdir:
-        for file in fdir:
-            if file.is_file():
-                os.remove(file.path)
-            else:
-                delete_dir(file.path, base)
-    os.rmdir(cur_dir)
+    # removes a directory with everything in it, files as they are found,
+    # then the directories, deepest first.
+    dirs = [cur_dir]
+    for file, is_dir in walk(cur_dir):
+        if is_dir:
+            dirs.append(file.path)
+        else:
+            os.remove(file.path)
+    for path in reversed(dirs):
+        os.rmdir(path)
 
 
 def receive_dir(path):
     # tries to create a directory, else nothing.
-    try:
-        os.mkdir(path)
-    finally:
-        pass
+    os.makedirs(path, exist_ok=True)
     return path
 
 
-def receive_file(client, path):
-    # receives a file from client at location path.
+def receive_file(client, path, store=None):
+    """
+    receives a file into a temporary file next to path, which replaces path
+    only once complete, so readers never see a half written file.
+
+    Parameters
+    ----------
+    client : socket
+        client socket.
+    path : str
+        file's path.
+    store : Store, optional
+        block store the file is kept in, if any. The default is None.
+
+    Returns
+    -------
+    None.
+
+    """
+    f_size = receive_file_size(client)
+    temp = scratch(path)
+    try:
+        with open(temp, "w+b") as file:
+            allocate(file, f_size)
+            receive_into(client, file, f_size)
+            # makes sure data is on disk before it becomes visible.
+            file.flush()
+            os.fsync(file.fileno())
+            if store is not None:
+                hashes = block_hashes(file)
+        if store is not None:
+            store.link(temp, path, hashes)
+        else:
+            os.replace(temp, path)
+    except BaseException:
+        # a dropped connection leaves no corrupt file behind.
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+@metrics.TRANSFERS.timed("in")
+def receive_piece(client, path, parts, lock, store=None):
+    """
+    receives a part of a file spread over streams into the file's temporary
+    file, which replaces path once all its parts are in.
+
+    Parameters
+    ----------
+    client : socket
+        the stream.
+    path : str
+        file's path.
+    parts : dict
+        path -> [bytes not received yet, whether temp was kept from an
+        earlier transfer], of each file being received in parts.
+    lock : Lock
+        guards parts.
+    store : Store, optional
+        block store the file is kept in, if any. The default is None.
+
+    Returns
+    -------
+    bool
+        True if it was the file's last part.
+
+    """
     f_size = receive_file_size(client)
-    # writes as long as there's still information incoming.
-    with open(path, "wb") as file:
-        while f_size > 0:
-            data = client.recv(f_size)
+    offset = receive_file_size(client)
+    length = receive_file_size(client)
+    temp = path + PARTIAL
+    with lock:
+        if path not in parts:
+            parts[path] = [f_size, open_partial(temp, f_size)]
+        resumed = parts[path][1]
+    try:
+        with open(temp, "r+b") as file:
+            receive_blocks(client, file, f_size, offset // STORE_BLOCK, store,
+                           resumed)
+            file.flush()
+            os.fsync(file.fileno())
+        with lock:
+            parts[path][0] -= length
+            if parts[path][0]:
+                return False
+            del parts[path]
+        if store is not None:
+            with open(temp, "rb") as file:
+                store.link(temp, path, block_hashes(file))
+        else:
+            os.replace(temp, path)
+        return True
+    except BaseException:
+        # temp is kept, the file's next transfer resumes from it.
+        with lock:
+            parts.pop(path, None)
+        raise
+
+
+def block_hashes(file):
+    # returns the hashes of an open file's store blocks.
+    file.seek(0)
+    return [block_hash(data) for data in iter(
+        lambda: file.read(STORE_BLOCK), b"")]
+
+
+def receive_hashed(client, path, store=None):
+    """
+    receives a file offered by send_hashed, asking only for blocks missing
+    from the store and from what an earlier transfer of the file that was
+    cut short kept of it.
+
+    Parameters
+    ----------
+    client : socket
+        client socket.
+    path : str
+        file's path.
+    store : Store, optional
+        the block store. The default is None, then only kept blocks are
+        skipped.
+
+    Returns
+    -------
+    None.
+
+    """
+    f_size = receive_file_size(client)
+    temp = path + PARTIAL
+    resumed = open_partial(temp, f_size)
+    with open(temp, "r+b") as file:
+        hashes = receive_blocks(client, file, f_size, 0, store, resumed)
+        file.flush()
+        os.fsync(file.fileno())
+    # temp is only kept if receiving failed, as the checkpoint.
+    if store is not None:
+        store.link(temp, path, hashes)
+    else:
+        os.replace(temp, path)
+
+
+def scratch(path):
+    # returns a temporary file next to path for a file received whole, one
+    # of its own so transfers of the same path at once don't mix. the one
+    # a transfer resumes from is path + PARTIAL.
+    return f"{path}.{os.urandom(4).hex()}{PARTIAL}"
+
+
+def open_partial(temp, f_size):
+    """
+    prepares the temporary file a file is received into, keeping what an
+    earlier transfer that was cut short left in it.
+
+    Parameters
+    ----------
+    temp : str
+        the temporary file's path.
+    f_size : int
+        the received file's size.
+
+    Returns
+    -------
+    bool
+        True if temp was kept from an earlier transfer.
+
+    """
+    resumed = os.path.exists(temp)
+    with open(temp, "r+b" if resumed else "wb") as file:
+        if resumed:
+            file.truncate(f_size)
+        allocate(file, f_size)
+    return resumed
+
+
+def receive_blocks(client, file, f_size, first, store=None, resumed=False):
+    """
+    receives blocks offered by send_blocks into their place in a file,
+    asking only for those missing from the store and, if the file was kept
+    from an earlier transfer, from the file itself. kept blocks are only
+    used once they hash as the sender's do, so a checkpoint can't corrupt
+    the file.
+
+    Parameters
+    ----------
+    client : socket
+        client socket.
+    file : file object
+        the file, opened for reading and writing in binary mode.
+    f_size : int
+        file's size.
+    first : int
+        index of the first block offered.
+    store : Store, optional
+        the block store. The default is None.
+    resumed : bool, optional
+        whether the file holds blocks of an earlier transfer. The default
+        is False.
+
+    Returns
+    -------
+    list
+        hashes of the blocks as written.
+
+    """
+    count = receive_file_size(client)
+    data = client.recv(count * HASH_SIZE)
+    hashes = [data[i:i + HASH_SIZE] for i in range(0, len(data), HASH_SIZE)]
+    stored = [store is not None and store.has_block(h) for h in hashes]
+    kept = [False] * count
+    if resumed:
+        for i in range(count):
+            if not stored[i]:
+                file.seek((first + i) * STORE_BLOCK)
+                kept[i] = block_hash(file.read(
+                    block_size(f_size, first + i))) == hashes[i]
+    client.sendall(bytes("".join(
+        "0" if stored[i] or kept[i] else "1" for i in range(count)), FORMAT))
+    for i in range(count):
+        if kept[i]:
+            continue
+        start = (first + i) * STORE_BLOCK
+        length = block_size(f_size, first + i)
+        file.seek(start)
+        if stored[i]:
+            file.write(store.read_block(hashes[i]))
+        else:
+            # hashes what was actually sent, file may have changed.
+            receive_into(client, file, length)
+            file.seek(start)
+            hashes[i] = block_hash(file.read(length))
+    return hashes
+
+
+def receive_into(client, file, count):
+    # writes count incoming bytes to file through one reusable buffer.
+    if receive_token(client) == PACKED:
+        receive_packed(client, file, count)
+        return
+    buffer = memoryview(bytearray(BLOCK))
+    while count > 0:
+        received = client.recv_into(buffer, min(BLOCK, count))
+        if not received:
+            raise ConnectionError("connection closed mid transfer")
+        with metrics.disk():
+            file.write(buffer[:received])
+        count -= received
+
+
+def receive_packed(client, file, count):
+    # writes count bytes sent by stream_packed to file. data inflating to
+    # more than promised is refused as soon as it does.
+    def write(data):
+        nonlocal count
+        count -= len(data)
+        if count < 0:
+            raise ConnectionError("compressed data longer than promised")
+        with metrics.disk():
             file.write(data)
-            f_size -= len(data)
+
+    unpacker = compress.Decompressor(client.codec, write)
+    length = receive_file_size(client)
+    while length:
+        if length > MAX_CHUNK:
+            raise ConnectionError("compressed chunk too long")
+        unpacker.decompress(client.recv(length))
+        length = receive_file_size(client)
+    if count:
+        raise ConnectionError("compressed data shorter than promised")
+
+
+def allocate(file, size):
+    # reserves disk space up front where the platform supports it.
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(file.fileno(), 0, size)
+        except OSError:
+            pass
+
+
+def file_state(path):
+    # returns what a path holds: None if missing, DIRECTORY, or file's
+    # size and modification time.
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if os.path.isdir(path):
+        return DIRECTORY
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def is_partial(path):
+    # checks if path is a file still being received.
+    return path.endswith(PARTIAL)
+
+
+def is_unsynced(path):
+    # checks if path is kept out of sync, being received or a placeholder.
+    return is_partial(path) or lazy.is_stub(path)
+
+
+def stub_only(path):
+    # checks if only a placeholder of the file at path is here.
+    return not os.path.lexists(path) and os.path.lexists(path + lazy.STUB)
+
+
+def receive_delta(client, path):
+    """
+    rebuilds a file from the blocks of it and the bytes sent by send_delta,
+    into a new file that replaces path only once complete, so a dropped
+    connection never leaves a half built file behind.
+
+    Parameters
+    ----------
+    client : socket
+        client socket.
+    path : str
+        file's path.
+
+    Returns
+    -------
+    None.
+
+    """
+    f_size = receive_file_size(client)
+    temp = scratch(path)
+    # tells the sender which blocks are already here.
+    send_signatures(client, path)
+    try:
+        # a new file also unshares one linked from the block store, the old
+        # one is where the runs of blocks are copied from.
+        old = open(path, "rb") if os.path.isfile(path) else io.BytesIO()
+        with old, open(temp, "wb") as file:
+            action = receive_token(client)
+            while action != DONE:
+                if action == DATA:
+                    file.write(client.recv(receive_file_size(client)))
+                else:
+                    old.seek(receive_file_size(client) * BLOCK)
+                    left = receive_file_size(client) * BLOCK
+                    with metrics.disk():
+                        data = old.read(min(BLOCK, left))
+                        while data and left:
+                            file.write(data)
+                            left -= len(data)
+                            data = old.read(min(BLOCK, left))
+                action = receive_token(client)
+            if file.tell() != f_size:
+                raise ConnectionError(f"delta of {path!r} is of {file.tell()}"
+                                      f" bytes, not {f_size}")
+            # makes sure data is on disk before it becomes visible.
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def receive_token(client):
+    # receives an action, file type or instruction.
+    return TOKENS[TOKEN.unpack(client.recv(TOKEN.size))[0]]
 
 
 def receive_path(client):
-    # receives path.
-    temp = client.recv(PATH_LEN).decode()
-    length = int(temp)
-    return client.recv(length).decode()
+    # receives path, refusing one that leads out of the folder.
+    length = LENGTH.unpack(client.recv(LENGTH.size))[0]
+    path = client.recv(length).decode(FORMAT)
+    if not is_contained(path):
+        raise ConnectionError(f"path {path!r} leads out of the folder")
+    return path
+
+
+def is_contained(path):
+    # checks if a relative path received stays inside its folder.
+    return bool(path) and not os.path.isabs(path) and \
+        ".." not in path.replace("\\", "/").split("/")
 
 
 def receive_file_size(client):
     # receives file's size.
-    temp = client.recv(FILE_SIZE).decode()
-    return int(temp)
+    return SIZE.unpack(client.recv(SIZE.size))[0]
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@author: Yotam Ben Dov 316387950
+@author: Nili Alfia 314880873
+"""
+
+import time
+import socket
+import struct
+import threading
+import metrics
+
+# sizes
+FRAME_SIZE = 65536  # buffered output is sent once it reaches this size.
+READ = 65536  # socket reads are buffered in reads of this size.
+MAX_PAYLOAD = 1073741824  # longest frame, larger streams are split.
+SLICE = 1048576  # paced files are sent in slices of this size.
+
+# miscellaneous
+VERSION = 8  # protocol version, carried by every frame.
+FRAME = struct.Struct(">BI")  # frame header: version, payload length.
+ACTIVE = 1  # seconds a party counts as using a limit after its last bytes.
+
+
+class Channel:
+    """
+    framed, buffered connection. everything sent is gathered into frames of
+    up to FRAME_SIZE bytes, so many small fields and updates go out in a
+    single send, and frames are only sent once the buffer fills, flush is
+    called or the channel is about to wait for a reply. on the receiving
+    end frames are read in large reads and recv always returns exactly the
+    bytes asked for, a short read can't cut a field in two.
+    """
+
+    def __init__(self, sock, buffered=b"", left=0):
+        """
+        Parameters
+        ----------
+        sock : socket
+            connected socket, owned by the channel from now on.
+        buffered : bytes, optional
+            bytes already read from the socket, for a channel taken over
+            from another process. The default is b"".
+        left : int, optional
+            payload bytes of the current frame among them. The default is 0.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.sock = sock
+        # frames are batched by the channel, not delayed by the kernel.
+        if sock.family in [socket.AF_INET, socket.AF_INET6]:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.out = bytearray()  # payload of the next frame.
+        self.buffer = bytearray(buffered)  # bytes read, not used yet.
+        self.start = 0  # position of the first unused byte in buffer.
+        self.left = left  # payload bytes of the current frame not used yet.
+        # further connections the payloads of a round are spread over.
+        self.streams = []
+        # codec files may be compressed with, agreed on at login.
+        self.codec = None
+        # share of a bandwidth limit the channel's traffic is paced by.
+        self.share = None
+
+    def fileno(self):
+        # lets a channel be waited on with select.
+        return self.sock.fileno()
+
+    def pending(self):
+        # checks if received bytes are buffered, select won't report them.
+        return self.start < len(self.buffer)
+
+    def handoff(self, read):
+        """
+        returns what a channel taking over the socket in another process
+        is created with, so it reads everything from read on.
+
+        Parameters
+        ----------
+        read : bytes
+            the last bytes received, to be received again.
+
+        Returns
+        -------
+        bytes
+            buffered bytes.
+        int
+            payload bytes of the current frame among them.
+
+        """
+        # read is taken as part of the current frame, the frames it came
+        # from were used up.
+        return read + bytes(self.buffer[self.start:]), len(read) + self.left
+
+    # sending.
+    def send(self, data):
+        # queues data, sending full frames as they fill.
+        self.out += data
+        if len(self.out) >= FRAME_SIZE:
+            self.flush()
+
+    sendall = send
+
+    def flush(self):
+        # sends whatever is queued as a frame.
+        if self.out:
+            data = FRAME.pack(VERSION, len(self.out)) + self.out
+            self.pace(len(data))
+            with metrics.network():
+                self.sock.sendall(data)
+            metrics.BYTES.add(len(data), "out")
+            self.out = bytearray()
+
+    def sendfile(self, file, offset, count):
+        """
+        sends count bytes of a file from offset, large ones in frames of
+        their own, straight from the file.
+
+        Parameters
+        ----------
+        file : file object
+            file opened in binary mode.
+        offset : int
+            where in the file to start.
+        count : int
+            number of bytes promised to the receiver, a file that shrank
+            meanwhile is padded with zeros.
+
+        Returns
+        -------
+        int
+            count.
+
+        """
+        if count < FRAME_SIZE:
+            file.seek(offset)
+            self.send(file.read(count).ljust(count, b"\0"))
+            return count
+        self.flush()
+        sent = 0
+        while sent < count:
+            length = min(count - sent, MAX_PAYLOAD)
+            with metrics.network():
+                self.sock.sendall(FRAME.pack(VERSION, length))
+            done = 0
+            # a paced file is sent in slices, each waiting for its share.
+            while done < length:
+                size = min(length - done, SLICE if self.share else length)
+                self.pace(size)
+                with metrics.network():
+                    sliced = self.sock.sendfile(file, offset + sent + done,
+                                                size)
+                done += sliced
+                if sliced < size:
+                    break
+            with metrics.network():
+                while done < length:
+                    padding = min(READ, length - done)
+                    self.sock.sendall(bytes(padding))
+                    done += padding
+            metrics.BYTES.add(FRAME.size + length, "out")
+            sent += length
+        return count
+
+    # receiving.
+    def recv(self, size):
+        # receives exactly size bytes.
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            received += self.recv_into(view[received:], size - received)
+        return bytes(data)
+
+    def recv_into(self, buffer, size):
+        """
+        receives up to size bytes into buffer, waiting only if none are
+        buffered.
+
+        Parameters
+        ----------
+        buffer : memoryview
+            writable buffer of at least size bytes.
+        size : int
+            most bytes to receive.
+
+        Returns
+        -------
+        int
+            number of bytes received, at least one.
+
+        """
+        while not self.left:
+            version, self.left = FRAME.unpack(self.take(FRAME.size))
+            if version != VERSION:
+                raise ConnectionError(f"bad protocol version {version}")
+        size = min(size, self.left)
+        if not self.pending() and size >= READ:
+            # large reads skip the buffer.
+            self.flush()
+            with metrics.network():
+                received = self.sock.recv_into(buffer, size)
+            if not received:
+                raise ConnectionError("connection closed mid transfer")
+            metrics.BYTES.add(received, "in")
+            self.pace(received)
+        else:
+            if not self.pending():
+                self.read()
+            received = min(size, len(self.buffer) - self.start)
+            buffer[:received] = self.buffer[self.start:self.start + received]
+            self.start += received
+        self.left -= received
+        return received
+
+    def take(self, size):
+        # returns the next size bytes read from the socket, frame headers
+        # included.
+        while len(self.buffer) - self.start < size:
+            self.read()
+        data = bytes(self.buffer[self.start:self.start + size])
+        self.start += size
+        return data
+
+    def read(self):
+        # reads from the socket into the buffer, sending what's queued first
+        # since the other side may be waiting on it.
+        self.flush()
+        with metrics.network():
+            data = self.sock.recv(READ)
+        if not data:
+            raise ConnectionError("connection closed mid transfer")
+        metrics.BYTES.add(len(data), "in")
+        self.pace(len(data))
+        del self.buffer[:self.start]
+        self.start = 0
+        self.buffer += data
+
+    def pace(self, size):
+        # waits for the channel's share of its limit to let size bytes by.
+        if self.share:
+            self.share.take(size)
+
+    # closing.
+    def shutdown(self, how):
+        # sends what's left and shuts the socket down.
+        try:
+            self.flush()
+        finally:
+            self.sock.shutdown(how)
+
+    def close(self):
+        # closes the channel along with its streams.
+        for stream in self.streams:
+            stream.close()
+        self.sock.close()
+
+
+class Limit:
+    """
+    bandwidth limit shared fairly between parties, like the users of a
+    server. each party is let through rate / n bytes a second, n being the
+    parties that used the limit in the last ACTIVE seconds, so a party alone
+    gets all of it and one with a huge transfer doesn't starve the rest.
+    sent and received bytes both count.
+    """
+
+    def __init__(self, rate):
+        """
+        Parameters
+        ----------
+        rate : float
+            bytes a second let through in all.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.parties = {}  # party -> (time its bytes so far are paid by,
+        #                              time it last took bytes).
+
+    def share(self, party):
+        # returns what a party's channels are paced by.
+        return Share(self, party)
+
+    def take(self, party, size):
+        # waits until party may pass size more bytes.
+        with self.lock:
+            now = time.monotonic()
+            for other, (paid, last) in list(self.parties.items()):
+                if now - last > ACTIVE and other != party:
+                    del self.parties[other]
+            paid = max(now, self.parties.get(party, (now, now))[0])
+            active = len(self.parties) + (party not in self.parties)
+            self.parties[party] = (paid + size * active / self.rate, now)
+        if paid > now:
+            time.sleep(paid - now)
+
+
+class Share:
+    """
+    a party's share of a Limit, set on each of its channels.
+    """
+
+    def __init__(self, limit, party):
+        self.limit = limit
+        self.party = party
+
+    def take(self, size):
+        self.limit.take(self.party, size)